@@ -1,28 +1,16 @@
 import os
-from typing import Union
+from datetime import datetime
+from typing import Optional, Union
 from fastapi import HTTPException, Depends, Request
+from fastapi.responses import JSONResponse
 import jwt
-from constants import API_RATE_LIMIT
-from slowapi import Limiter
-from slowapi.util import get_remote_address
 from utils.db_client import MongoDBHandler
+from utils.image_io import read_image_request
 from services.image_generation_service import ImageGenerationService
 from services.user_service import SECRET_KEY, UserService
 from utils.data_types import APIKey, ChangePasswordDataType, EmailDataType, Prompt, TextPrompt, TextToImage, ImageToImage, UserSigninInfo, ValidatorInfo, ChatCompletion
 from utils.db_client import MongoDBHandler
 
-def get_api_key(request: Request):
-    return request.headers.get("API_KEY", get_remote_address(request))
-
-limiter = Limiter(key_func=get_api_key)
-def dynamic_rate_limit(request: Request):  # Add request parameter
-    # check if the user's role is pro or standard
-    # user_role = request.headers.get("User-Role", "default")  # Example header
-    # if user_role == "pro":
-    #     return PRO_API_RATE_LIMIT  # Premium users get a higher limit
-    # else:
-    return API_RATE_LIMIT  # Default limit for regular users
-
 MONGOUSER = os.getenv("MONGOUSER")
 MONGOPASSWORD = os.getenv("MONGOPASSWORD")
 MONGOHOST = os.getenv("MONGOHOST", "localhost")
@@ -30,25 +18,54 @@ MONGOPORT = os.getenv("MONGOPORT", 27017)
 CLASSIFIER_URL = os.getenv("CLASSIFIER_URL")
 
 
+# Constructing the handlers doesn't touch the network, the app lifespan initializes them
 dbhandler = MongoDBHandler()
-# verify db connection
-print(dbhandler.client.server_info())
 
 # Initialize AuthService with the dbhandler
 user_service = UserService(dbhandler)  
 
 app = ImageGenerationService(dbhandler, user_service)
 
+RATE_LIMIT_EXEMPT_PATHS = {
+    "/health", "/ready", "/metrics", "/api/v1/stripe-webhook",
+    "/api/v1/admin/signin", "/api/v1/admin/get_users", "/api/v1/admin/delete_user",
+}
+
+@app.app.middleware("http")
+async def rate_limit(request: Request, call_next):
+    if request.url.path in RATE_LIMIT_EXEMPT_PATHS:
+        return await call_next(request)
+    api_key = request.headers.get("API_KEY")
+    if not api_key and request.headers.get("Authorization"):
+        api_key = request.headers.get("Authorization").replace("Bearer ", "")
+    # Index only: an unknown key must not cost a database round trip per request
+    account = app.dbhandler.auth_key_index.get(api_key, lookup=False)
+    if account is not None:
+        result = await app.limiter.check(f"account:{account['_id']}", account)
+    else:
+        result = await app.limiter.check(f"ip:{request.client.host if request.client else 'unknown'}")
+    if not result.allowed:
+        return JSONResponse(status_code=429, content={"detail": "Rate limit exceeded"}, headers=result.headers())
+    response = await call_next(request)
+    response.headers.update(result.headers())
+    return response
+
 async def api_key_checker(request: Request = None):
     client_host = request.client.host
     print(client_host, flush=True)
-    try:
-        json_data = await request.json()
-    except Exception as e:
-        print(e, flush=True)
-        json_data = {}
-    api_key = request.headers.get("API_KEY") or json_data.get("key") or request.headers.get("Authorization").replace("Bearer ", "")
-    if not api_key or api_key not in app.dbhandler.get_auth_keys():
+    api_key = request.headers.get("API_KEY")
+    # Only fall back to the body for JSON requests, image uploads are never parsed here
+    content_type = request.headers.get("content-type", "")
+    if not api_key and not content_type.startswith(("multipart/", "image/", "application/octet-stream")):
+        try:
+            json_data = await request.json()
+        except Exception as e:
+            print(e, flush=True)
+            json_data = {}
+        api_key = json_data.get("key") if isinstance(json_data, dict) else None
+    if not api_key and request.headers.get("Authorization"):
+        api_key = request.headers.get("Authorization").replace("Bearer ", "")
+    if not api_key or await app.dbhandler.auth_key_index.aget(api_key) is None:
         raise HTTPException(status_code=403, detail="Invalid or missing API key")
 
 async def is_admin(request: Request):
@@ -65,58 +82,57 @@ async def is_admin(request: Request):
 
 
 @app.app.post("/api/v1/txt2img", dependencies=[Depends(api_key_checker)])
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
-async def txt2img_api2(request: Request, data: TextToImage):
-    return await app.txt2img_api(request, data, CLASSIFIER_URL)
+async def txt2img_api2(request: Request):
+    data, _ = await read_image_request(request, TextToImage, image_field=None)
+    output = await app.txt2img_api(request, data, CLASSIFIER_URL)
+    return await app.image_response(request, output)
 
 @app.app.post("/get_credentials")
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
 async def get_credentials(request: Request, validator_info: ValidatorInfo):
     return await app.get_credentials(request, validator_info)
 
 @app.app.post("/generate", dependencies=[Depends(api_key_checker)])
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
 async def generate(request: Request, prompt: Union[Prompt, TextPrompt]):
-    return await app.generate(prompt)
+    return await app.generate(prompt, request=request)
 
 @app.app.get("/get_validators", dependencies=[Depends(api_key_checker)])
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
 async def get_validators(request: Request):
     return await app.get_validators(request)
 
 @app.app.post("/api/v1/img2img", dependencies=[Depends(api_key_checker)])
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
-async def img2img_api(request: Request, data: ImageToImage):
-    return await app.img2img_api(request, data)
+async def img2img_api(request: Request):
+    data, image = await read_image_request(request, ImageToImage)
+    output = await app.img2img_api(request, data, image)
+    return await app.image_response(request, output)
 
 @app.app.post("/api/v1/instantid", dependencies=[Depends(api_key_checker)])
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
-async def instantid_api(request: Request, data: ImageToImage):
-    return await app.instantid_api(request, data)
+async def instantid_api(request: Request):
+    data, image = await read_image_request(request, ImageToImage)
+    output = await app.instantid_api(request, data, image)
+    return await app.image_response(request, output)
 
 @app.app.post("/api/v1/controlnet", dependencies=[Depends(api_key_checker)])
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
-async def controlnet_api(request: Request, data: ImageToImage):
-    return await app.controlnet_api(request, data)
+async def controlnet_api(request: Request):
+    data, image = await read_image_request(request, ImageToImage)
+    output = await app.controlnet_api(request, data, image)
+    return await app.image_response(request, output)
 
 @app.app.post("/api/v1/upscale", dependencies=[Depends(api_key_checker)])
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
-async def upscale_api(request: Request, data: ImageToImage):
-    return await app.upscale_api(request, data)
+async def upscale_api(request: Request):
+    data, image = await read_image_request(request, ImageToImage)
+    output = await app.upscale_api(request, data, image)
+    return await app.image_response(request, output)
 
 @app.app.post("/api/v1/chat/completions", dependencies=[Depends(api_key_checker)])
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
 async def chat_completions_api(request: Request, data: ChatCompletion):
     return await app.chat_completions(request, data)
 
 @app.app.post("/api/v1/signin")
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
 def signin(request: Request, data: UserSigninInfo):
     user = user_service.signin(request, data)
     return {"message": "User signed in successfully", "user": user}
 
 @app.app.post("/api/v1/signup")
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
 def signup(request: Request, data: UserSigninInfo):
     insert_result = user_service.signup(request, data)
     if insert_result:
@@ -125,16 +141,14 @@ def signup(request: Request, data: UserSigninInfo):
         raise HTTPException(status_code=500, detail="Failed to create user")
 
 @app.app.get("/api/v1/get_user_info", dependencies=[Depends(api_key_checker)])
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
 async def get_user_info(request: Request):
-    userInfo = user_service.get_user_info(request)
+    userInfo = await user_service.get_user_info(request)
     if userInfo:
         return {"message": "User data fetched successfully", "user": userInfo}
     else:
         raise HTTPException(status_code=500, detail="Failed to fetch user data")
 
 @app.app.get("/api/v1/add_api_key", dependencies=[Depends(api_key_checker)])
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
 def add_api_key(request: Request):
     apiKey = user_service.add_api_key(request)
     if apiKey:
@@ -143,7 +157,6 @@ def add_api_key(request: Request):
         raise HTTPException(status_code=500, detail="Failed to add API key")
 
 @app.app.post("/api/v1/delete_api_key", dependencies=[Depends(api_key_checker)])
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
 def delete_api_key(request: Request, data: APIKey):
     apiKey = user_service.delete_api_key(request, data.key)
     if apiKey:
@@ -152,21 +165,18 @@ def delete_api_key(request: Request, data: APIKey):
         raise HTTPException(status_code=500, detail="Failed to delete API key")
     
 @app.app.get("/api/v1/get_logs", dependencies=[Depends(api_key_checker)])
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
-def get_logs(request: Request):
-    logs = user_service.get_logs(request)
-    if logs:
-        return {"message": "Retrieved Logs", "logs": logs}
-    else:
-        raise HTTPException(status_code=500, detail="Failed to get logs")
+def get_logs(request: Request, since: Optional[datetime] = None, until: Optional[datetime] = None,
+             limit: Optional[int] = None, action: Optional[str] = None, cursor: Optional[str] = None, format: str = "json"):
+    if format == "ndjson" or "application/x-ndjson" in request.headers.get("Accept", ""):
+        return user_service.stream_logs(request, since, until, action, cursor)
+    page = user_service.get_logs(request, since, until, limit, action, cursor)
+    return {"message": "Retrieved Logs", "logs": page["logs"], "next_cursor": page["next_cursor"]}
 
 @app.app.post("/api/v1/admin/reset_password", dependencies=[Depends(is_admin)])
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
 async def reset_password(request: Request):
     return await user_service.reset_password(request)
 
 @app.app.post("/api/v1/change_password", dependencies=[Depends(api_key_checker)])
-@limiter.limit(API_RATE_LIMIT) # Update the rate limit
 def change_password(request: Request, data: ChangePasswordDataType):
     return user_service.change_password(request, data)
 
@@ -28,6 +28,9 @@ class CollectionName(Enum):
   MODEL_CONFIG = "model_config"
   PRIVATE_KEY = "private_key"
   LOGS = "logs"
+  USAGE = "usage"
+  LEASES = "leases"
+  METAGRAPH = "metagraph"
   
 class LOGS_ACTION(Enum):
   SIGNUP = "User Sign Up"
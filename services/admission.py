@@ -0,0 +1,190 @@
+import asyncio
+import heapq
+import itertools
+import json
+import math
+import os
+import time
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+from prometheus_client import Counter, Gauge, Histogram
+
+from utils.rate_limit import DEFAULT_TIER
+
+# Requests each worker process dispatches to validators at once, per model and pipeline.
+# Queues and caps live in the worker, so N workers admit up to N times this in total.
+ADMISSION_MAX_IN_FLIGHT_PER_WORKER = int(os.getenv("ADMISSION_MAX_IN_FLIGHT_PER_WORKER", 64))
+# JSON object of model key ("<model>|<pipeline>") -> per-worker in-flight cap, overriding the default
+ADMISSION_MODEL_LIMITS_PER_WORKER = json.loads(os.getenv("ADMISSION_MODEL_LIMITS_PER_WORKER", "{}"))
+# Longest a request may wait for a slot before it is shed
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 30))
+ADMISSION_MAX_QUEUED_PER_ACCOUNT = int(os.getenv("ADMISSION_MAX_QUEUED_PER_ACCOUNT", 32))
+# JSON object of tier -> share of the slots, merged over the defaults below
+ADMISSION_TIER_WEIGHTS = {
+    "standard": 1.0,
+    "pro": 4.0,
+    **json.loads(os.getenv("ADMISSION_TIER_WEIGHTS", "{}")),
+}
+# Assumed time a request holds its slot until real ones have been measured
+ADMISSION_DEFAULT_SERVICE_TIME = 10.0
+SERVICE_TIME_ALPHA = 0.1
+
+ADMISSION_QUEUE_DEPTH = Gauge("admission_queue_depth", "Requests waiting for a dispatch slot", ["model"])
+ADMISSION_IN_FLIGHT = Gauge("admission_in_flight", "Requests holding a dispatch slot in this worker", ["model"])
+ADMISSION_WAIT_SECONDS = Histogram(
+    "admission_wait_seconds",
+    "Time spent waiting for a dispatch slot",
+    ["model", "tier", "outcome"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60),
+)
+ADMISSION_SHED = Counter("admission_shed_total", "Requests rejected by the admission scheduler", ["model", "reason"])
+
+
+class Waiter:
+    __slots__ = ("account", "future")
+
+    def __init__(self, account: str):
+        self.account = account
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class AdmissionQueue:
+    # Weighted fair queuing over accounts for one model: every queued request gets a
+    # virtual finish tag advancing by 1 / weight from its account's previous tag, and
+    # free slots go to the smallest tag. An account with weight 4 gets four slots for
+    # every one of a weight 1 account while both are backlogged, and a burst from one
+    # account only queues behind itself.
+    def __init__(self, model: str, capacity: int):
+        self.model = model
+        self.capacity = capacity
+        self.in_flight = 0
+        self.depth = 0
+        self.virtual_time = 0.0
+        self.service_time = ADMISSION_DEFAULT_SERVICE_TIME
+        self._heap = []
+        self._seq = itertools.count()
+        # account -> [finish tag of its last queued request, requests queued]
+        self._accounts: Dict[str, list] = {}
+
+    def expected_wait(self) -> float:
+        return (self.depth + 1) / self.capacity * self.service_time
+
+    def retry_after(self) -> str:
+        return str(max(math.ceil(self.expected_wait()), 1))
+
+    def queued(self, account: str) -> int:
+        state = self._accounts.get(account)
+        return state[1] if state else 0
+
+    def enqueue(self, account: str, weight: float) -> Waiter:
+        state = self._accounts.setdefault(account, [self.virtual_time, 0])
+        state[0] = max(state[0], self.virtual_time) + 1 / weight
+        state[1] += 1
+        waiter = Waiter(account)
+        heapq.heappush(self._heap, (state[0], next(self._seq), waiter))
+        self.depth += 1
+        ADMISSION_QUEUE_DEPTH.labels(model=self.model).set(self.depth)
+        return waiter
+
+    def _dequeued(self, account: str) -> None:
+        self.depth -= 1
+        ADMISSION_QUEUE_DEPTH.labels(model=self.model).set(self.depth)
+        state = self._accounts[account]
+        state[1] -= 1
+        if state[1] == 0:
+            # Nothing left behind its last tag, the next request starts from the virtual time again
+            del self._accounts[account]
+
+    def abandon(self, waiter: Waiter) -> None:
+        # Timed out or cancelled while queued; the heap entry is skipped when it comes up
+        waiter.future.cancel()
+        self._dequeued(waiter.account)
+
+    def take(self) -> None:
+        self.in_flight += 1
+        ADMISSION_IN_FLIGHT.labels(model=self.model).set(self.in_flight)
+
+    def release(self, held: Optional[float]) -> None:
+        self.in_flight -= 1
+        ADMISSION_IN_FLIGHT.labels(model=self.model).set(self.in_flight)
+        if held is not None:
+            self.service_time += SERVICE_TIME_ALPHA * (held - self.service_time)
+        self.grant()
+
+    def grant(self) -> None:
+        while self._heap and self.in_flight < self.capacity:
+            tag, _, waiter = heapq.heappop(self._heap)
+            if waiter.future.done():
+                continue
+            self.virtual_time = tag
+            self._dequeued(waiter.account)
+            self.take()
+            waiter.future.set_result(None)
+
+
+class Admission:
+    __slots__ = ("queue", "started")
+
+    def __init__(self, queue: AdmissionQueue):
+        self.queue = queue
+        self.started = time.monotonic()
+
+
+class AdmissionScheduler:
+    def __init__(self):
+        self.queues: Dict[str, AdmissionQueue] = {}
+
+    def queue_for(self, model: str) -> AdmissionQueue:
+        queue = self.queues.get(model)
+        if queue is None:
+            capacity = int(ADMISSION_MODEL_LIMITS_PER_WORKER.get(model, ADMISSION_MAX_IN_FLIGHT_PER_WORKER))
+            queue = self.queues[model] = AdmissionQueue(model, capacity)
+        return queue
+
+    def shed(self, queue: AdmissionQueue, reason: str, status_code: int, detail: str) -> HTTPException:
+        ADMISSION_SHED.labels(model=queue.model, reason=reason).inc()
+        return HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": queue.retry_after()})
+
+    async def acquire(self, model: str, account: Dict, timeout: float = ADMISSION_QUEUE_TIMEOUT) -> Admission:
+        # Waits up to timeout for a dispatch slot; raises 429 when the account already has
+        # too many requests queued and 503 when the wait would exceed the timeout
+        queue = self.queue_for(model)
+        tier = account.get("tier", DEFAULT_TIER)
+        if queue.in_flight < queue.capacity and not queue.depth:
+            queue.take()
+            ADMISSION_WAIT_SECONDS.labels(model=model, tier=tier, outcome="admitted").observe(0)
+            return Admission(queue)
+        account_id = str(account["temp_id"])
+        if queue.queued(account_id) >= ADMISSION_MAX_QUEUED_PER_ACCOUNT:
+            raise self.shed(queue, "account_queue_full", 429, "Too many queued requests")
+        # Don't queue what would time out anyway
+        if queue.expected_wait() > timeout:
+            raise self.shed(queue, "overloaded", 503, "Validators are at capacity, retry later")
+
+        weight = ADMISSION_TIER_WEIGHTS.get(tier, ADMISSION_TIER_WEIGHTS[DEFAULT_TIER])
+        waiter = queue.enqueue(account_id, weight)
+        start_time = time.monotonic()
+        try:
+            await asyncio.wait((waiter.future,), timeout=timeout)
+        except BaseException:
+            # Client went away while queued, hand on the slot if it was granted meanwhile
+            if waiter.future.done() and not waiter.future.cancelled():
+                queue.release(None)
+            else:
+                queue.abandon(waiter)
+            ADMISSION_WAIT_SECONDS.labels(model=model, tier=tier, outcome="cancelled").observe(
+                time.monotonic() - start_time
+            )
+            raise
+        waited = time.monotonic() - start_time
+        if not waiter.future.done():
+            queue.abandon(waiter)
+            ADMISSION_WAIT_SECONDS.labels(model=model, tier=tier, outcome="timeout").observe(waited)
+            raise self.shed(queue, "queue_timeout", 503, "Timed out waiting for a validator, retry later")
+        ADMISSION_WAIT_SECONDS.labels(model=model, tier=tier, outcome="admitted").observe(waited)
+        return Admission(queue)
+
+    def release(self, admission: Optional[Admission]) -> None:
+        if admission is not None:
+            admission.queue.release(time.monotonic() - admission.started)
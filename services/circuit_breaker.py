@@ -0,0 +1,115 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Dict
+
+from prometheus_client import Counter, Gauge
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 3))
+CIRCUIT_OPEN_DURATION = float(os.getenv("CIRCUIT_OPEN_DURATION", 30))
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+CIRCUIT_TRANSITIONS = Counter(
+    "validator_circuit_transitions_total",
+    "Validator circuit breaker state transitions",
+    ["hotkey", "from_state", "to_state"],
+)
+CIRCUIT_STATE = Gauge(
+    "validator_circuit_state", "Validator circuit breaker state (0 closed, 1 half-open, 2 open)", ["hotkey"]
+)
+
+
+class CircuitBreaker:
+    def __init__(self, hotkey: str):
+        self.hotkey = hotkey
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.labels(hotkey=hotkey).set(STATE_VALUES[CLOSED])
+
+    def _transition(self, state: str) -> None:
+        if state == self.state:
+            return
+        print(f"Validator {self.hotkey} circuit {self.state} -> {state}", flush=True)
+        CIRCUIT_TRANSITIONS.labels(hotkey=self.hotkey, from_state=self.state, to_state=state).inc()
+        CIRCUIT_STATE.labels(hotkey=self.hotkey).set(STATE_VALUES[state])
+        self.state = state
+        if state == OPEN:
+            self.opened_at = time.time()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            return self.state == CLOSED
+
+    def should_probe(self) -> bool:
+        # Open long enough: move to half-open and let exactly one probe through
+        with self._lock:
+            if self.state == OPEN and time.time() - self.opened_at >= CIRCUIT_OPEN_DURATION:
+                self._transition(HALF_OPEN)
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._transition(CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+                self._transition(OPEN)
+
+
+class CircuitBreakerRegistry:
+    def __init__(self, probe: Callable[[str], Awaitable[bool]]):
+        # probe(hotkey) sends the lightweight recheck payload and reports whether it succeeded
+        self.probe = probe
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        # Half-open probes in flight, referenced so they aren't garbage collected mid-run
+        self._probes = set()
+
+    def get(self, hotkey: str) -> CircuitBreaker:
+        breaker = self._breakers.get(hotkey)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(hotkey, CircuitBreaker(hotkey))
+        return breaker
+
+    def allow(self, hotkey: str) -> bool:
+        breaker = self.get(hotkey)
+        if breaker.should_probe():
+            task = asyncio.ensure_future(self._run_probe(breaker))
+            self._probes.add(task)
+            task.add_done_callback(self._probes.discard)
+        return breaker.allow_request()
+
+    async def close(self) -> None:
+        for task in list(self._probes):
+            task.cancel()
+        if self._probes:
+            await asyncio.gather(*self._probes, return_exceptions=True)
+
+    def record_success(self, hotkey: str) -> None:
+        self.get(hotkey).record_success()
+
+    def record_failure(self, hotkey: str) -> None:
+        self.get(hotkey).record_failure()
+
+    async def _run_probe(self, breaker: CircuitBreaker) -> None:
+        try:
+            healthy = await self.probe(breaker.hotkey)
+        except Exception as e:
+            print(f"Probe of validator {breaker.hotkey} failed: {e}", flush=True)
+            healthy = False
+        if healthy:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
@@ -0,0 +1,156 @@
+import asyncio
+import os
+import time
+from datetime import datetime
+from typing import Dict
+
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from constants import CollectionName
+
+# Number of requests' worth of credit a hot key leases into a local bucket, 0 disables buckets
+CREDIT_BUCKET_REQUESTS = int(os.getenv("CREDIT_BUCKET_REQUESTS", 0))
+# Unused leased credit is returned to MongoDB after this many idle seconds
+CREDIT_BUCKET_IDLE_TTL = float(os.getenv("CREDIT_BUCKET_IDLE_TTL", 30))
+DEFAULT_CREDIT = 5
+
+
+class Reservation:
+    def __init__(self, account_id, amount: float):
+        self.account_id = account_id
+        self.amount = amount
+        self.done = False
+
+
+class CreditBucket:
+    def __init__(self):
+        self.tokens = 0.0
+        self.touched = time.time()
+        self.lock = asyncio.Lock()
+
+
+class CreditLedger:
+    def __init__(self, dbhandler):
+        self.dbhandler = dbhandler
+        self._buckets: Dict[object, CreditBucket] = {}
+        self._task = None
+        # Credit returns still being written
+        self._credits = set()
+
+    async def start(self) -> None:
+        if CREDIT_BUCKET_REQUESTS > 0:
+            self._task = asyncio.create_task(self._return_idle_buckets())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for account_id in list(self._buckets):
+            self._return_bucket(account_id)
+        if self._credits:
+            await asyncio.gather(*self._credits, return_exceptions=True)
+
+    def available(self, account: Dict) -> float:
+        # Credit left in MongoDB plus whatever is already leased into the local bucket
+        bucket = self._buckets.get(account["temp_id"])
+        return account["credit"] + (bucket.tokens if bucket is not None else 0)
+
+    async def reserve(self, account: Dict, amount: float) -> Reservation:
+        account_id = account["temp_id"]
+        if CREDIT_BUCKET_REQUESTS > 0:
+            reserved = await self._reserve_from_bucket(account_id, amount)
+        else:
+            reserved = await self._reserve_from_db(account_id, amount)
+        if not reserved:
+            raise HTTPException(status_code=403, detail="Run out of credit")
+        return Reservation(account_id, amount)
+
+    def settle(self, reservation: Reservation) -> None:
+        if reservation.done:
+            return
+        reservation.done = True
+        self.dbhandler.writer.increment(
+            CollectionName.AUTH_KEYS.value,
+            reservation.account_id,
+            {"request_count": 1},
+            {"updated_at": datetime.utcnow()},
+        )
+
+    def refund(self, reservation: Reservation) -> None:
+        if reservation.done:
+            return
+        reservation.done = True
+        bucket = self._buckets.get(reservation.account_id)
+        if bucket is not None:
+            bucket.tokens += reservation.amount
+            return
+        self._credit(reservation.account_id, reservation.amount)
+
+    async def _reserve_from_bucket(self, account_id, amount: float) -> bool:
+        bucket = self._buckets.setdefault(account_id, CreditBucket())
+        async with bucket.lock:
+            bucket.touched = time.time()
+            if bucket.tokens < amount:
+                # Lease a batch of credit so the next requests don't need a round trip
+                lease = amount * CREDIT_BUCKET_REQUESTS - bucket.tokens
+                if await self._reserve_from_db(account_id, lease):
+                    bucket.tokens += lease
+                elif not await self._reserve_from_db(account_id, amount - bucket.tokens):
+                    return False
+                else:
+                    bucket.tokens = amount
+            bucket.tokens -= amount
+            return True
+
+    async def _reserve_from_db(self, account_id, amount: float) -> bool:
+        collection = self.dbhandler.aio.auth_keys_collection
+        for _ in range(2):
+            doc = await collection.find_one_and_update(
+                {"_id": account_id, "credit": {"$gte": amount}},
+                {"$inc": {"credit": -amount}, "$set": {"updated_at": datetime.utcnow()}},
+                projection={"credit": 1},
+                return_document=ReturnDocument.AFTER,
+            )
+            if doc is not None:
+                self.dbhandler.auth_key_index.patch(account_id, {"credit": round(doc["credit"], 3)})
+                return True
+            # Older accounts have no credit field and get the default, materialize it and retry
+            result = await collection.update_one(
+                {"_id": account_id, "credit": {"$exists": False}},
+                {"$set": {"credit": DEFAULT_CREDIT}},
+            )
+            if not result.modified_count:
+                return False
+        return False
+
+    def _credit(self, account_id, amount: float) -> None:
+        if amount <= 0:
+            return
+        # Written directly rather than through the write-behind queue, whose retries can repeat an $inc
+        task = asyncio.ensure_future(self._write_credit(account_id, amount))
+        self._credits.add(task)
+        task.add_done_callback(self._credits.discard)
+
+    async def _write_credit(self, account_id, amount: float) -> None:
+        try:
+            await self.dbhandler.aio.auth_keys_collection.update_one(
+                {"_id": account_id},
+                {"$inc": {"credit": amount}, "$set": {"updated_at": datetime.utcnow()}},
+            )
+        except PyMongoError as e:
+            print(f"Failed to return {amount} credit to {account_id}: {e}", flush=True)
+
+    def _return_bucket(self, account_id) -> None:
+        bucket = self._buckets.pop(account_id, None)
+        if bucket is not None:
+            self._credit(account_id, bucket.tokens)
+
+    async def _return_idle_buckets(self) -> None:
+        while True:
+            await asyncio.sleep(CREDIT_BUCKET_IDLE_TTL)
+            now = time.time()
+            for account_id, bucket in list(self._buckets.items()):
+                if now - bucket.touched > CREDIT_BUCKET_IDLE_TTL and not bucket.lock.locked():
+                    self._return_bucket(account_id)
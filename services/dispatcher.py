@@ -0,0 +1,139 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from prometheus_client import Counter
+
+from utils.deadline import Deadline
+
+# sequential | hedged | fanout-<N>
+DISPATCH_STRATEGY = os.getenv("DISPATCH_STRATEGY", "sequential")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 95))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", 10))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", 0.5))
+HEDGE_MIN_SAMPLES = 20
+# Retries and hedges across all requests are capped at RETRY_BUDGET_RATIO of the
+# requests, plus RETRY_BUDGET_MIN_PER_SECOND so a quiet proxy can still retry
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", 0.2))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", 1))
+RETRY_BUDGET_BURST = float(os.getenv("RETRY_BUDGET_BURST", 20))
+# Not worth starting an attempt with less time than this left
+MIN_ATTEMPT_TIMEOUT = float(os.getenv("MIN_ATTEMPT_TIMEOUT", 2))
+
+VALIDATOR_RETRIES = Counter("validator_retries_total", "Retry and hedge attempts by budget decision", ["outcome"])
+
+
+def parse_strategy(strategy: str) -> Tuple[str, int]:
+    strategy = strategy.strip().lower()
+    if strategy == "sequential":
+        return "sequential", 1
+    if strategy == "hedged":
+        return "hedged", 2
+    if strategy.startswith("fanout"):
+        _, _, count = strategy.partition("-")
+        return "fanout", max(int(count or 2), 1)
+    raise ValueError(f"Unknown dispatch strategy: {strategy}")
+
+
+class RetryBudget:
+    # Token bucket filled by requests rather than by time: every request deposits
+    # ratio tokens and every retry spends one, so retries can't amplify an outage
+    def __init__(
+        self,
+        ratio: float = RETRY_BUDGET_RATIO,
+        min_per_second: float = RETRY_BUDGET_MIN_PER_SECOND,
+        burst: float = RETRY_BUDGET_BURST,
+    ):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def _refill(self, amount: float = 0.0) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.tokens + amount + (now - self.updated_at) * self.min_per_second, self.burst)
+        self.updated_at = now
+
+    def deposit(self) -> None:
+        self._refill(self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill()
+        allowed = self.tokens >= 1
+        if allowed:
+            self.tokens -= 1
+        VALIDATOR_RETRIES.labels(outcome="allowed" if allowed else "denied").inc()
+        return allowed
+
+
+class ValidatorDispatcher:
+    def __init__(self, strategy: str = DISPATCH_STRATEGY):
+        self.mode, self.max_in_flight = parse_strategy(strategy)
+        self._latencies = deque(maxlen=512)
+        self.retry_budget = RetryBudget()
+        print(f"Validator dispatch strategy: {strategy}", flush=True)
+
+    def record_latency(self, latency: float) -> None:
+        self._latencies.append(latency)
+
+    def hedge_delay(self) -> float:
+        if len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        latencies = sorted(self._latencies)
+        index = min(int(len(latencies) * HEDGE_PERCENTILE / 100), len(latencies) - 1)
+        return max(latencies[index], HEDGE_MIN_DELAY)
+
+    async def dispatch(
+        self,
+        candidates: List,
+        pick: Callable[[List], str],
+        attempt: Callable[[str], Awaitable[Optional[dict]]],
+        deadline: Optional[Deadline] = None,
+    ) -> Optional[dict]:
+        # pick() removes and returns the next hotkey from candidates,
+        # attempt() returns the validator output or None on failure.
+        # Sequential keeps one request in flight, fan-out keeps N, hedged keeps one
+        # and adds a second when the first is slower than the latency percentile.
+        # Attempts after the first round are paid from the retry budget, and none
+        # start once the deadline is too close.
+        base_in_flight = self.max_in_flight if self.mode == "fanout" else 1
+        self.retry_budget.deposit()
+        started = 0
+        pending = set()
+
+        def can_start() -> bool:
+            if deadline is not None and deadline.remaining() < MIN_ATTEMPT_TIMEOUT:
+                return False
+            return started < base_in_flight or self.retry_budget.withdraw()
+
+        try:
+            while True:
+                while candidates and len(pending) < base_in_flight and can_start():
+                    pending.add(asyncio.ensure_future(attempt(pick(candidates))))
+                    started += 1
+                if not pending:
+                    return None
+                timeout = None
+                if self.mode == "hedged" and candidates and len(pending) < self.max_in_flight:
+                    timeout = self.hedge_delay()
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    if can_start():
+                        print(f"Hedging request after {timeout:.2f} seconds", flush=True)
+                        pending.add(asyncio.ensure_future(attempt(pick(candidates))))
+                        started += 1
+                    continue
+                for task in done:
+                    output = task.result()
+                    if output:
+                        return output
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import random
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Tuple
+
+from prometheus_client import Counter, Histogram
+from pymongo import UpdateOne
+
+PROBE_CONCURRENCY = int(os.getenv("PROBE_CONCURRENCY", 16))
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", 8))
+# Failing or flapping validators are probed every PROBE_MIN_INTERVAL seconds, the interval
+# doubles with every success up to PROBE_MAX_INTERVAL for stable ones
+PROBE_MIN_INTERVAL = float(os.getenv("PROBE_MIN_INTERVAL", 30))
+PROBE_MAX_INTERVAL = float(os.getenv("PROBE_MAX_INTERVAL", 600))
+PROBE_JITTER = float(os.getenv("PROBE_JITTER", 0.2))
+PROBE_TICK = 2.0
+# Outcome changes are counted with this decay per probe, at 1 or above a validator counts as flapping
+FLAP_DECAY = 0.7
+
+PROBE_SECONDS = Histogram(
+    "validator_probe_seconds",
+    "Latency of validator health probes",
+    ["outcome"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8),
+)
+PROBES = Counter("validator_probes_total", "Validator health probes", ["outcome"])
+
+
+class ProbeSchedule:
+    def __init__(self, now: float):
+        self.interval = PROBE_MIN_INTERVAL
+        # Spread the first round so validators aren't all probed at once
+        self.next_due = now + random.uniform(0, PROBE_MIN_INTERVAL)
+        self.last_ok = None
+        self.flaps = 0.0
+
+    def record(self, ok: bool, now: float) -> None:
+        self.flaps *= FLAP_DECAY
+        if self.last_ok is not None and ok != self.last_ok:
+            self.flaps += 1
+        self.last_ok = ok
+        if not ok or self.flaps >= 1:
+            self.interval = PROBE_MIN_INTERVAL
+        else:
+            self.interval = min(self.interval * 2, PROBE_MAX_INTERVAL)
+        self.next_due = now + self.interval * random.uniform(1 - PROBE_JITTER, 1 + PROBE_JITTER)
+
+
+class HealthProber:
+    def __init__(
+        self,
+        probe: Callable[[str], Awaitable[bool]],
+        validators: Callable[[], Dict],
+        collection,
+        on_result: Callable[[str, bool, float], None],
+    ):
+        # probe(hotkey) sends the recheck payload, validators() returns the current
+        # hotkey -> validator mapping, on_result feeds breakers and selection
+        self.probe = probe
+        self.validators = validators
+        self.collection = collection
+        self.on_result = on_result
+        self.schedules: Dict[str, ProbeSchedule] = {}
+        self._semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+
+    async def run(self, is_leader: Callable[[], bool]) -> None:
+        while True:
+            await asyncio.sleep(PROBE_TICK)
+            if not is_leader():
+                continue
+            try:
+                await self.probe_due()
+            except Exception as e:
+                print(f"Validator health probing failed: {e}", flush=True)
+
+    async def probe_due(self) -> None:
+        now = time.monotonic()
+        validators = self.validators()
+        for hotkey in list(self.schedules):
+            if hotkey not in validators:
+                del self.schedules[hotkey]
+        due = [
+            hotkey
+            for hotkey in list(validators)
+            if self.schedules.setdefault(hotkey, ProbeSchedule(now)).next_due <= now
+        ]
+        if not due:
+            return
+        results = await asyncio.gather(*(self._probe(hotkey) for hotkey in due))
+        checked_at = datetime.utcnow()
+        await self.collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": hotkey},
+                    {"$set": {
+                        "is_active": ok,
+                        "health": {"ok": ok, "latency": latency, "checked_at": checked_at},
+                    }},
+                )
+                for hotkey, ok, latency in results
+            ],
+            ordered=False,
+        )
+        failed = sum(1 for _, ok, _ in results if not ok)
+        print(f"Probed {len(results)} validators, {failed} failed", flush=True)
+
+    async def _probe(self, hotkey: str) -> Tuple[str, bool, float]:
+        async with self._semaphore:
+            start_time = time.perf_counter()
+            try:
+                ok = await asyncio.wait_for(self.probe(hotkey), PROBE_TIMEOUT)
+            except Exception as e:
+                print(f"Validator {hotkey} probe failed: {e}", flush=True)
+                ok = False
+            latency = time.perf_counter() - start_time
+        outcome = "success" if ok else "failure"
+        PROBE_SECONDS.labels(outcome=outcome).observe(latency)
+        PROBES.labels(outcome=outcome).inc()
+        schedule = self.schedules.get(hotkey)
+        if schedule is not None:
+            schedule.record(ok, time.monotonic())
+        self.on_result(hotkey, ok, latency)
+        return hotkey, ok, latency
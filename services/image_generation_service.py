@@ -1,25 +1,56 @@
 import asyncio
 import base64
-import io
-import requests
+import os
 import random
-from datetime import datetime, date
-from typing import Dict, List, Union
+from datetime import date
+from typing import Dict, List, Optional, Union
 import time
-import bittensor as bt
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import anyio
 import httpx
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response
 from PIL import Image
-from threading import Thread
-from constants import LOGS_ACTION, STYLE_TO_MODEL_MAPPING, ModelName
+from threading import Event, Lock, Thread
+from constants import LOGS_ACTION, CollectionName, ModelName
 from prometheus_fastapi_instrumentator import Instrumentator
 from PIL import Image
-from utils.common import pil_image_to_base64
 from utils.data_types import Prompt, TextPrompt, TextToImage, ImageToImage, ValidatorInfo, ChatCompletion
+from utils.db_base import MONGO_SYNC_THREADS
+from utils.deadline import REQUESTS_ABANDONED, Deadline, cancel_on_disconnect
+from utils.http_pool import HTTPClientPool, ResponseTooLarge
+from utils.leader_lease import LeaderLease
+from utils.metagraph_snapshot import MetagraphSnapshot
+from utils.rate_limit import RateLimiter
+from utils.model_config import ModelConfigSnapshot
+from utils.result_cache import RESULT_CACHE_HIT_COST_RATIO, ResultCache, cache_key
+from utils.image_io import media_type_for, negotiate_image_format
+from utils.image_processing import MAX_IMAGE_BYTES, ImageExecutor, check_image_size, encode_image, image_to_base64
+from utils import image_processing
+from services.admission import ADMISSION_QUEUE_TIMEOUT, AdmissionScheduler
+from services.circuit_breaker import CircuitBreakerRegistry
+from services.credit_ledger import CreditLedger
+from services.dispatcher import MIN_ATTEMPT_TIMEOUT, ValidatorDispatcher
+from services.health_prober import HealthProber
+from services.prompt_classifier import PromptClassifier
+from services.prompt_preprocessor import SPECULATIVE_DISPATCH, SPECULATIVE_DISPATCHES, PromptPreprocessor
+from services.validator_scorer import create_scorer, model_key
 from fastapi.middleware.cors import CORSMiddleware
-from transformers import AutoTokenizer
+
+METAGRAPH_CACHE_PATH = os.getenv("METAGRAPH_CACHE_PATH", "metagraph_snapshot.json")
+# How often every worker picks up validator health and the metagraph published by the leader
+VALIDATOR_SYNC_INTERVAL = float(os.getenv("VALIDATOR_SYNC_INTERVAL", 15))
+METAGRAPH_DOC_ID = "current"
+DALLE_FETCH_TIMEOUT = float(os.getenv("DALLE_FETCH_TIMEOUT", 30))
+DALLE_MAX_IMAGE_BYTES = int(os.getenv("DALLE_MAX_IMAGE_BYTES", MAX_IMAGE_BYTES))
+TOKENIZER_CACHE_DIR = os.getenv("TOKENIZER_CACHE_DIR")
+# Only load tokenizers already in the local cache, never reach the Hugging Face hub
+TOKENIZERS_OFFLINE = os.getenv("TOKENIZERS_OFFLINE", "false").lower() == "true"
+# Served while the service is still starting, everything else gets a 503
+STARTUP_EXEMPT_PATHS = {"/ready", "/health", "/metrics"}
 
 # Define a list of allowed origins (domains)
 allowed_origins = [
@@ -28,16 +59,55 @@ allowed_origins = [
     "http://54.203.165.0:3000"
 ]
 
+def load_tokenizer(repo: str):
+    # Deferred: importing transformers is slow and only chat completions need it
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(
+        repo, cache_dir=TOKENIZER_CACHE_DIR, local_files_only=TOKENIZERS_OFFLINE
+    )
+
+
 class ImageGenerationService:
     def __init__(self, dbhandler, auth_service):
+        # Keep this cheap: it runs at import time. Chain, database and tokenizer
+        # work happens in initialize() once the server is already accepting connections.
         self.dbhandler = dbhandler
         self.auth_service = auth_service
-        self.subtensor = bt.subtensor("finney")
-        self.metagraph = self.subtensor.metagraph(23)
-        
-        self.available_validators = self.dbhandler.get_available_validators()
-        self.filter_validators()
-        self.app = FastAPI()
+        self.ready = False
+        self.subtensor = None
+        self.metagraph = None
+        self.metagraph_snapshot = MetagraphSnapshot()
+        self._metagraph_synced = Event()
+        # available_validators belongs to the event loop, the metagraph thread hands its snapshots over
+        self._loop = None
+        self._snapshot_lock = Lock()
+        self.available_validators = {}
+        self.tokenizers = {}
+        self._tokenizer_locks = {}
+        self.scorer = create_scorer()
+        self.http_pool = HTTPClientPool()
+        self.dispatcher = ValidatorDispatcher()
+        # Per-tenant fair queuing in front of the dispatcher, per model and pipeline
+        self.admission = AdmissionScheduler()
+        # Token buckets shared by every worker, keyed on the account and sized by its tier
+        self.limiter = RateLimiter()
+        self.breakers = CircuitBreakerRegistry(self.probe_validator)
+        self.ledger = CreditLedger(self.dbhandler)
+        self.image_executor = ImageExecutor()
+        self.result_cache = ResultCache()
+        self.classifier = PromptClassifier(self.http_pool)
+        self.prompt_preprocessor = PromptPreprocessor(self.http_pool)
+        # With several workers only the lease holder syncs the chain and probes validators
+        self.lease = LeaderLease(self.dbhandler.leases_collection, "background-jobs")
+        self._background_tasks = []
+        self.health_prober = HealthProber(
+            self.probe_validator,
+            lambda: self.available_validators,
+            self.dbhandler.aio.validators_collection,
+            self.record_probe,
+        )
+        self.app = FastAPI(lifespan=self.lifespan)
         # Add CORSMiddleware to the application instance
         self.app.add_middleware(
             CORSMiddleware,
@@ -46,46 +116,183 @@ class ImageGenerationService:
             allow_methods=["*"],  # Allows all methods
             allow_headers=["*"],  # Allows all headers
         )
-        self.auth_keys = self.dbhandler.get_auth_keys()
+        self.app.middleware("http")(self.require_ready)
+        self.app.get("/health")(self.health)
+        self.app.get("/ready")(self.readiness)
+        self.message = "image-generating-subnet"
+
+        Instrumentator().instrument(self.app).expose(self.app)
+
+    async def initialize(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        for step in (self.dbhandler.initialize, self.load_state):
+            while True:
+                try:
+                    await asyncio.to_thread(step)
+                    break
+                except Exception as e:
+                    print(f"Startup step {step.__name__} failed, retrying: {e}", flush=True)
+                    await asyncio.sleep(5)
+
+        cached_snapshot = MetagraphSnapshot.load(METAGRAPH_CACHE_PATH)
+        if cached_snapshot is not None:
+            print(f"Loaded cached metagraph from block {cached_snapshot.block}", flush=True)
+            self.metagraph_snapshot = cached_snapshot
+        await asyncio.to_thread(self.lease.start)
+        Thread(target=self.sync_metagraph_periodically, daemon=True).start()
+        # Followers get the leader's metagraph and validator health through MongoDB
+        self._background_tasks.append(asyncio.create_task(self.sync_db_periodically()))
+        if cached_snapshot is None:
+            # Nothing to warm-start from, validators can't be selected before the first sync
+            await asyncio.to_thread(self._metagraph_synced.wait)
+
+        self.prune_validators(self.metagraph_snapshot)
+        self.publish_snapshot()
+        self._background_tasks.append(
+            asyncio.create_task(self.health_prober.run(lambda: self.lease.is_leader))
+        )
+        self.ready = True
+        print("Service ready", flush=True)
+
+    def load_state(self) -> None:
+        self.available_validators = self.dbhandler.get_available_validators()
+        for hotkey, validator in self.available_validators.items():
+            self.scorer.load(hotkey, validator.get("scorer"))
         self.private_key = self.load_private_key()
         self.public_key = self.private_key.public_key()
         self.public_key_bytes = self.public_key.public_bytes(
             encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw
         )
-        model_list_entry = self.dbhandler.model_config.find_one({"name": "model_list"})
-        self.model_list = model_list_entry["data"] if model_list_entry else {}
-        self.message = "image-generating-subnet"
         self.signature = base64.b64encode(
             self.private_key.sign(self.message.encode("utf-8"))
         )
+        self.recheck_request = {
+            "payload": {"recheck": True},
+            "model_name": "proxy-service",
+            "authorization": base64.b64encode(self.public_key_bytes).decode("utf-8"),
+        }
 
-        self.loop = asyncio.get_event_loop()
+    async def require_ready(self, request: Request, call_next):
+        if not self.ready and request.url.path not in STARTUP_EXEMPT_PATHS:
+            return JSONResponse(
+                status_code=503,
+                content={"detail": "Service is starting"},
+                headers={"Retry-After": "5"},
+            )
+        return await call_next(request)
 
-        Instrumentator().instrument(self.app).expose(self.app)
-        Thread(target=self.sync_metagraph_periodically, daemon=True).start()
-        Thread(target=self.recheck_validators, daemon=True).start()
+    async def health(self):
+        return {"status": "ok"}
 
-        self.tokenizer_config = self.dbhandler.model_config.find_one({"name": "tokenizer"})
-        print(self.tokenizer_config, flush=True)
-        self.tokenizers = {
-            k: AutoTokenizer.from_pretrained(v) for k, v in self.tokenizer_config["data"].items()
+    async def readiness(self):
+        if not self.ready:
+            return JSONResponse(status_code=503, content={"ready": False})
+        return {
+            "ready": True,
+            "metagraph_block": self.metagraph_snapshot.block,
+            "model_config_version": self.config.version,
         }
-        print(self.tokenizers, flush=True)
-        
-    def sync_db(self):
-        new_available_validators = self.dbhandler.get_available_validators()
-        for key, value in new_available_validators.items():
-            if key not in self.available_validators:
-                self.available_validators[key] = value
-        self.auth_keys = self.dbhandler.get_auth_keys()
-
-    def filter_validators(self) -> None:
+
+    @property
+    def config(self) -> ModelConfigSnapshot:
+        # Hot-reloaded in the background, read it once per request for a consistent view
+        return self.dbhandler.model_config_store.current
+
+    @property
+    def model_list(self):
+        return self.config.model_list
+
+    @asynccontextmanager
+    async def lifespan(self, app: FastAPI):
+        # Sync route handlers and asyncio.to_thread/run_in_executor (blocking driver
+        # calls included) share these bounds instead of growing without limit
+        anyio.to_thread.current_default_thread_limiter().total_tokens = MONGO_SYNC_THREADS
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=MONGO_SYNC_THREADS, thread_name_prefix="sync")
+        )
+        await self.http_pool.start()
+        await self.dbhandler.writer.start()
+        await self.ledger.start()
+        await self.result_cache.start()
+        initialize_task = asyncio.create_task(self.initialize())
+        yield
+        initialize_task.cancel()
+        for task in self._background_tasks:
+            task.cancel()
+        await self.breakers.close()
+        await asyncio.to_thread(self.lease.release)
+        # Return leased credit before the database clients close
+        await self.ledger.stop()
+        await self.dbhandler.writer.stop()
+        self.dbhandler.close()
+        await self.http_pool.close()
+        await self.limiter.close()
+        self.image_executor.shutdown()
+
+    async def sync_db(self):
+        # MongoDB is the shared view: registrations can land on any worker,
+        # health checks and deregistrations come from the leader
+        docs = await self.dbhandler.aget_available_validators()
+        changed = False
+        for hotkey, doc in docs.items():
+            validator = self.available_validators.get(hotkey)
+            if validator is None:
+                self.available_validators[hotkey] = doc
+                self.scorer.load(hotkey, doc.get("scorer"))
+                changed = True
+                continue
+            if any(validator.get(field) != doc.get(field) for field in ("is_active", "generate_endpoint")):
+                validator["is_active"] = doc.get("is_active")
+                validator["generate_endpoint"] = doc.get("generate_endpoint")
+                changed = True
+            health = doc.get("health")
+            if health and health != validator.get("health"):
+                validator["health"] = health
+                # The leader already fed its own scorer when it ran the probe
+                if not self.lease.is_leader:
+                    self.scorer.record_health(hotkey, health["latency"], health["ok"])
+        for hotkey in list(self.available_validators):
+            if hotkey not in docs:
+                self.available_validators.pop(hotkey, None)
+                changed = True
+
+        snapshot = None
+        doc = await self.dbhandler.aio.metagraph_collection.find_one({"_id": METAGRAPH_DOC_ID}, {"block": 1})
+        if doc is not None and doc.get("block", 0) > self.metagraph_snapshot.block:
+            doc = await self.dbhandler.aio.metagraph_collection.find_one({"_id": METAGRAPH_DOC_ID})
+            snapshot = MetagraphSnapshot.from_dict(doc)
+            print(f"Picked up metagraph from block {snapshot.block}", flush=True)
+            await asyncio.to_thread(snapshot.save, METAGRAPH_CACHE_PATH)
+        if changed or snapshot is not None:
+            self.publish_snapshot(snapshot)
+        if snapshot is not None:
+            self._metagraph_synced.set()
+
+    async def sync_db_periodically(self):
+        while True:
+            try:
+                await self.sync_db()
+            except Exception as e:
+                print(f"Failed to sync validators from MongoDB: {e}", flush=True)
+            await asyncio.sleep(VALIDATOR_SYNC_INTERVAL)
+
+    def publish_snapshot(self, snapshot: MetagraphSnapshot = None) -> None:
+        # Re-filter the active validators against the given (or current) metagraph snapshot
+        with self._snapshot_lock:
+            snapshot = snapshot or self.metagraph_snapshot
+            self.metagraph_snapshot = snapshot.with_active(self.available_validators.copy())
+
+    def prune_validators(self, snapshot: MetagraphSnapshot) -> None:
+        # Drop validators that are no longer registered; the leader's metagraph thread deletes them from MongoDB
         for hotkey in list(self.available_validators.keys()):
-            self.available_validators[hotkey]["is_active"] = False
-            if hotkey not in self.metagraph.hotkeys:
+            if hotkey not in snapshot:
                 print(f"Removing validator {hotkey}", flush=True)
-                self.dbhandler.validators_collection.delete_one({"_id": hotkey})
-                self.available_validators.pop(hotkey)
+                self.available_validators.pop(hotkey, None)
+
+    def apply_metagraph(self, snapshot: MetagraphSnapshot) -> None:
+        # On the event loop, scheduled by the metagraph thread
+        self.prune_validators(snapshot)
+        self.publish_snapshot(snapshot)
 
     def load_private_key(self) -> Ed25519PrivateKey:
         # Load private key from MongoDB or generate a new one
@@ -106,13 +313,41 @@ class ImageGenerationService:
             return private_key
 
     def sync_metagraph_periodically(self) -> None:
+        # Deferred: importing bittensor alone takes seconds
+        import bittensor as bt
+
         while True:
-            print("Syncing metagraph", flush=True)
-            self.metagraph.sync(subtensor=self.subtensor, lite=True)
+            if not self.lease.is_leader:
+                time.sleep(5)
+                continue
+            try:
+                if self.metagraph is None:
+                    print("Connecting to subtensor", flush=True)
+                    self.subtensor = bt.subtensor("finney")
+                    self.metagraph = self.subtensor.metagraph(23)
+                else:
+                    print("Syncing metagraph", flush=True)
+                    self.metagraph.sync(subtensor=self.subtensor, lite=True)
+                # Only this thread touches self.metagraph, requests read the published snapshot
+                snapshot = MetagraphSnapshot.from_metagraph(self.metagraph)
+                self._loop.call_soon_threadsafe(self.apply_metagraph, snapshot)
+                self._metagraph_synced.set()
+                snapshot.save(METAGRAPH_CACHE_PATH)
+                # Published for the other workers, they pick it up in sync_db
+                self.dbhandler.metagraph_collection.replace_one(
+                    {"_id": METAGRAPH_DOC_ID}, snapshot.to_dict(), upsert=True
+                )
+                if snapshot.hotkeys:
+                    # Deregistered validators, apply_metagraph drops them from memory
+                    self.dbhandler.validators_collection.delete_many({"_id": {"$nin": list(snapshot.hotkeys)}})
+            except Exception as e:
+                print(f"Failed to sync metagraph: {e}", flush=True)
+                time.sleep(30)
+                continue
             time.sleep(60 * 10)
 
-    def check_auth(self, key: str) -> None:
-        if key not in self.dbhandler.get_auth_keys():
+    async def check_auth(self, key: str) -> None:
+        if await self.dbhandler.auth_key_index.aget(key) is None:
             raise HTTPException(status_code=401, detail="Invalid authorization key")
 
     async def get_credentials(
@@ -120,27 +355,31 @@ class ImageGenerationService:
     ) -> Dict:
         client_ip = request.headers.get('X-Real-Ip') or request.client.host
         uid = validator_info.uid
-        hotkey = self.metagraph.hotkeys[uid]
+        snapshot = self.metagraph_snapshot
+        if not 0 <= uid < len(snapshot.hotkeys):
+            raise HTTPException(status_code=404, detail="Invalid uid")
+        hotkey = snapshot.hotkeys[uid]
         postfix = validator_info.postfix
 
         if not postfix:
             raise HTTPException(status_code=404, detail="Invalid postfix")
 
+        registration = {
+            "generate_endpoint": "http://" + client_ip + postfix,
+            "is_active": True,
+        }
         new_validator = self.available_validators.setdefault(hotkey, {})
-        new_validator.update(
-            {
-                "generate_endpoint": "http://" + client_ip + postfix,
-                "is_active": True,
-            }
-        )
+        new_validator.update(registration)
 
         print(
             f"Found validator\n- hotkey: {hotkey}, uid: {uid}, endpoint: {new_validator['generate_endpoint']}",
             flush=True,
         )
-        self.dbhandler.validators_collection.update_one(
-            {"_id": hotkey}, {"$set": new_validator}, upsert=True
+        await self.dbhandler.aio.validators_collection.update_one(
+            # Only the registration: counter and scorer are accumulated through the write-behind queue
+            {"_id": hotkey}, {"$set": registration}, upsert=True
         )
+        self.publish_snapshot()
 
         return {
             "message": self.message,
@@ -148,158 +387,142 @@ class ImageGenerationService:
         }
 
     async def check_prompt(self, prompt: str):
-        try:
-            endpoint = "https://api.midjourneyapi.xyz/mj/v2/validation"
-            data = {
-                "prompt": prompt,
-            }
-            async with httpx.AsyncClient(timeout=4) as client:
-                response = await client.post(endpoint, json=data)
-            response = response.json()
-            print(response, flush=True)
-            if not response["ErrorMessage"]:
-                return True, ""
-            else:
-                print(response["ErrorMessage"], flush=True)
-                return False, response["ErrorMessage"]
-        except Exception as e:
-            print(e, flush=True)
-            return True, ""
-
-    async def generate(self, prompt: Union[Prompt, TextPrompt]):
-        self.auth_keys = self.dbhandler.get_auth_keys()
-        if prompt.model_name not in self.model_list:
+        return await self.prompt_preprocessor.check(prompt)
+
+    async def generate(
+        self, prompt: Union[Prompt, TextPrompt], cacheable: bool = None, request: Optional[Request] = None
+    ):
+        # End-to-end budget for queuing and every validator attempt
+        deadline = Deadline.for_request(request, getattr(prompt, "pipeline_type", "text_generation"))
+        account = await self.dbhandler.auth_key_index.aget(prompt.key)
+        if account is None:
+            raise HTTPException(status_code=403, detail="Invalid or missing API key")
+        config = self.config
+        if prompt.model_name not in config.model_list:
             raise HTTPException(status_code=404, detail="Model not found")
-        if self.auth_keys[prompt.key]["credit"] < self.model_list[prompt.model_name].get("credit_cost", 0.001):
+        model_cost = config.credit_cost(prompt.model_name)
+        # Cheap pre-check from the index, the ledger reserves atomically before dispatch
+        if self.ledger.available(account) < model_cost:
             raise HTTPException(status_code=403, detail="Run out of credit")
-                
-        self.sync_db()
-        if isinstance(prompt, Prompt):
-            is_safe_prompt, reason = await self.check_prompt(prompt.prompt)
-            if not is_safe_prompt:
-                return HTTPException(
-                    status_code=406, detail=f"Prompt checking: {reason}"
-                )
-            if prompt.pipeline_params.get("use_expansion", False):
-                try:
-                    async with httpx.AsyncClient(timeout=4) as client:
-                        response = await client.post(
-                            "http://213.173.102.215:10354/api/prompt_expansion",
-                            json={"prompt": prompt.prompt},
-                        )
-                    if response.status_code == 200:
-                        prompt.prompt = response.json()
-                except Exception as e:
-                    print(e, flush=True)
 
-        validatorItems = self.available_validators.items()
-        hotkeys = [
-            hotkey
-            for hotkey, log in validatorItems
-            if log["is_active"]
-        ]
-        hotkeys = [hotkey for hotkey in hotkeys if hotkey in self.metagraph.hotkeys]
-        stakes = [
-            self.metagraph.total_stake[self.metagraph.hotkeys.index(hotkey)]
-            for hotkey in hotkeys
-        ]
+        # Only a seed picked by the client makes the output reproducible
+        if cacheable is None:
+            cacheable = prompt.seed > 0
+        # Nobody is waiting for the output once the client hangs up
+        if not (self.result_cache.enabled and cacheable):
+            return await cancel_on_disconnect(
+                request, self.generate_upstream(prompt, account, model_cost, deadline)
+            )
+        output, hit = await cancel_on_disconnect(request, self.result_cache.get_or_compute(
+            cache_key(prompt),
+            lambda: self.generate_upstream(prompt, account, model_cost, deadline),
+        ))
+        if hit:
+            await self.bill_cache_hit(prompt, account, model_cost)
+        return output
 
-        validators = list(zip(hotkeys, stakes))
+    async def bill_cache_hit(self, prompt: Union[Prompt, TextPrompt], account: Dict, model_cost: float) -> None:
+        pipeline_type = getattr(prompt, "pipeline_type", "text_generation")
+        cost = round(model_cost * RESULT_CACHE_HIT_COST_RATIO, 6)
+        if cost > 0:
+            reservation = await self.ledger.reserve(account, cost)
+            await self.dbhandler.writer.wait_for_capacity()
+            self.ledger.settle(reservation)
+            self.auth_service.record_usage(
+                account["temp_id"], prompt.key, prompt.model_name, pipeline_type, cost
+            )
+        self.auth_service.log_user_activity(prompt.key, LOGS_ACTION.APICALL.value, f"{pipeline_type} (cached)", 200, prompt.model_name, cost)
+
+    async def generate_upstream(
+        self, prompt: Union[Prompt, TextPrompt], account: Dict, model_cost: float, deadline: Deadline
+    ):
+        # Moderation still running when dispatch starts, only with SPECULATIVE_DISPATCH
+        moderation = None
+        if isinstance(prompt, Prompt):
+            moderation, prompt.prompt = await self.prompt_preprocessor.prepare(
+                prompt.prompt, prompt.pipeline_params.get("use_expansion", False)
+            )
+            if not (SPECULATIVE_DISPATCH and not moderation.done()):
+                is_safe_prompt, reason = await moderation
+                moderation = None
+                if not is_safe_prompt:
+                    raise HTTPException(
+                        status_code=406, detail=f"Prompt checking: {reason}"
+                    )
 
         request_dict = {
             "payload": dict(prompt),
             "authorization": base64.b64encode(self.public_key_bytes).decode("utf-8"),
         }
-        output = None
-        while len(validators) and not output:
-            stakes = [stake for _, stake in validators]
-            validator = random.choices(validators, weights=stakes, k=1)[0]
-            hotkey, stake = validator
-            validators.remove(validator)
-            validator_counter = self.available_validators[hotkey].setdefault(
-                "counter", {}
-            )
-            today_counter = validator_counter.setdefault(
-                str(date.today()), {"success": 0, "failure": 0}
+        pipeline_type = getattr(prompt, "pipeline_type", "text_generation")
+        model = model_key(prompt.model_name, pipeline_type)
+        # Wait for a slot on this model before holding any credit
+        admission = None
+        try:
+            admission = await self.admission.acquire(
+                model, account, timeout=min(ADMISSION_QUEUE_TIMEOUT, deadline.remaining())
             )
-            print(f"Selected validator: {hotkey}, stake: {stake}", flush=True)
-            try:
-                start_time = time.time()
-                async with httpx.AsyncClient(
-                    timeout=httpx.Timeout(connect=2, timeout=64)
-                ) as client:
-                    response = await client.post(
-                        self.available_validators[hotkey]["generate_endpoint"],
-                        json=request_dict,
+            reservation = await self.ledger.reserve(account, model_cost)
+        except BaseException:
+            self.admission.release(admission)
+            if moderation is not None:
+                moderation.cancel()
+            raise
+        # Picked once the slot is granted: the queue wait can outlast a prune or a tripped
+        # breaker, and half-open probe permits shouldn't go to requests that are never admitted
+        validators = [
+            (hotkey, stake)
+            for hotkey, stake in self.metagraph_snapshot.active_validators
+            if self.breakers.allow(hotkey)
+        ]
+        # Validators can drop work the client has given up on
+        request_dict["deadline"] = deadline.epoch()
+        dispatch = asyncio.ensure_future(self.dispatcher.dispatch(
+            validators,
+            lambda validators: self.pick_validator(validators, model),
+            lambda hotkey: self.call_validator(hotkey, request_dict, model, deadline),
+            deadline,
+        ))
+        try:
+            if moderation is not None:
+                is_safe_prompt, reason = await moderation
+                SPECULATIVE_DISPATCHES.labels(outcome="confirmed" if is_safe_prompt else "cancelled").inc()
+                if not is_safe_prompt:
+                    dispatch.cancel()
+                    await asyncio.gather(dispatch, return_exceptions=True)
+                    self.ledger.refund(reservation)
+                    raise HTTPException(
+                        status_code=406, detail=f"Prompt checking: {reason}"
                     )
-                end_time = time.time()
-                print(
-                    f"Received response from validator {hotkey} in {end_time - start_time:.2f} seconds",
-                    flush=True,
-                )
-            except Exception as e:
-                print(f"Failed to send request to validator {hotkey}: {e}", flush=True)
-                continue
-            status_code = response.status_code
+            output = await dispatch
+        except BaseException:
+            dispatch.cancel()
+            if moderation is not None:
+                moderation.cancel()
+            self.ledger.refund(reservation)
+            raise
+        finally:
+            self.admission.release(admission)
+        if output:
+            # Charge once per user request, however many validators were tried
             try:
-                response = response.json()
-            except Exception as e:
-                response = {"error": str(e)}
-
-            if status_code == 200:
-                print(f"Received response from validator {hotkey}", flush=True)
-                output = response
-
-            if output:
-                today_counter["success"] += 1
-            else:
-                today_counter["failure"] += 1
-            try:
-                self.dbhandler.validators_collection.update_one(
-                    {"_id": hotkey}, {"$set": self.available_validators[hotkey]}
+                await self.dbhandler.writer.wait_for_capacity()
+                self.ledger.settle(reservation)
+                self.auth_service.record_usage(
+                    account["temp_id"], prompt.key, prompt.model_name, pipeline_type, model_cost
                 )
-                self.auth_keys[prompt.key].setdefault("request_count", 0)
-                self.auth_keys[prompt.key]["request_count"] += 1
-                
-                model_cost = self.model_list[prompt.model_name].get("credit_cost", 0.001)
-                self.auth_keys[prompt.key]["credit"] = round(
-                    self.auth_keys[prompt.key]["credit"] - model_cost,
-                    3
-                )
-                # Check if "usage" is a valid list before appending
-                if isinstance(self.auth_keys[prompt.key].get("usage"), list):
-                    self.auth_keys[prompt.key]["usage"].append({
-                        "model_name": prompt.model_name,
-                        "pipeline_type": prompt.pipeline_type,
-                        "credit_cost": model_cost,
-                        "timestamp": datetime.utcnow(),
-                    })
-                else:
-                    # Initialize "usage" as a list if it doesn't exist or is not a list
-                    self.auth_keys[prompt.key]["usage"] = [{
-                        "model_name": prompt.model_name,
-                        "pipeline_type": prompt.pipeline_type,
-                        "credit_cost": model_cost,
-                        "timestamp": datetime.utcnow(),
-                    }]
-                
-                # Convert prompt.key to ObjectId if it's a string
-                key_id = self.auth_keys[prompt.key]['temp_id']
-                
-                # Create a copy of the dictionary to avoid modifying the original
-                update_data = self.auth_keys[prompt.key].copy()
-                update_data["_id"] = update_data["temp_id"]
-
-                # Remove the _id field if it exists
-                update_data.pop("temp_id", None)
-                self.dbhandler.auth_keys_collection.update_one(
-                    {"_id": key_id}, {"$set": update_data}
-                )
-                
-                self.auth_service.log_user_activity(prompt.key, LOGS_ACTION.APICALL.value, prompt.pipeline_type, 200, prompt.model_name, model_cost)
+                self.auth_service.log_user_activity(prompt.key, LOGS_ACTION.APICALL.value, pipeline_type, 200, prompt.model_name, model_cost)
             except Exception as e:
-                print(f"Failed to update validator - MongoDB: {e}", flush=True)
+                print(f"Failed to update auth key - MongoDB: {e}", flush=True)
+        else:
+            self.ledger.refund(reservation)
         if not output:
+            await self.dbhandler.writer.wait_for_capacity()
+            # The dispatcher stops starting attempts shortly before the deadline
+            if deadline.remaining() < MIN_ATTEMPT_TIMEOUT:
+                REQUESTS_ABANDONED.labels(reason="deadline").inc()
+                self.auth_service.log_user_activity(prompt.key, LOGS_ACTION.APICALL.value, "Deadline exceeded", 504, prompt.model_name, 0)
+                raise HTTPException(status_code=504, detail="Request deadline exceeded")
             if not len(self.available_validators):
                 self.auth_service.log_user_activity(prompt.key, LOGS_ACTION.APICALL.value, "No available validators", 404, prompt.model_name, 0)
                 raise HTTPException(status_code=404, detail="No available validators")
@@ -307,60 +530,124 @@ class ImageGenerationService:
             raise HTTPException(status_code=500, detail="All validators failed")
         return output
 
-    def recheck_validators(self) -> None:
-        request_dict = {
-            "payload": {"recheck": True},
-            "model_name": "proxy-service",
-            "authorization": base64.b64encode(self.public_key_bytes).decode("utf-8"),
-        }
+    def pick_validator(self, validators: List, model: str) -> str:
+        validator = self.scorer.pick(validators, model)
+        hotkey, stake = validator
+        validators.remove(validator)
+        print(f"Selected validator: {hotkey}, stake: {stake}", flush=True)
+        return hotkey
 
-        def check_validator(hotkey):
-            with httpx.Client(timeout=httpx.Timeout(8)) as client:
-                try:
-                    response = client.post(
-                        self.available_validators[hotkey]["generate_endpoint"],
-                        json=request_dict,
-                    )
-                    response.raise_for_status()
-                    print(f"Validator {hotkey} responded", flush=True)
-                except Exception as e:
-                    print(f"Validator {hotkey} failed to respond: {e}", flush=True)
-                    # Set is_active to False if validator is not responding
-                    self.available_validators[hotkey]["is_active"] = False
+    async def call_validator(self, hotkey: str, request_dict: Dict, model: str, deadline: Deadline):
+        output = None
+        validator = self.available_validators.get(hotkey)
+        if validator is None:
+            # Pruned since the candidates were picked, move on to the next one
+            print(f"Validator {hotkey} is gone, skipping", flush=True)
+            return None
+        start_time = time.time()
+        try:
+            # Bounded by what is left of the request's budget, not a fixed timeout per attempt
+            response = await asyncio.wait_for(
+                self.http_pool.post_validator(
+                    validator["generate_endpoint"],
+                    json=request_dict,
+                ),
+                deadline.remaining(),
+            )
+            end_time = time.time()
+            print(
+                f"Received response from validator {hotkey} in {end_time - start_time:.2f} seconds",
+                flush=True,
+            )
+        except asyncio.TimeoutError:
+            # The request's deadline ran out, which says nothing about the validator
+            print(f"Request deadline reached while waiting for validator {hotkey}", flush=True)
+            return None
+        except Exception as e:
+            print(f"Failed to send request to validator {hotkey}: {e}", flush=True)
+            if hotkey not in self.available_validators:
+                # Removed while the call was in flight, not the validator's failure to score
+                return None
+            self.scorer.record(hotkey, model, time.time() - start_time, False)
+            if isinstance(e, httpx.TransportError):
+                # Connect/read failures count towards tripping the breaker, HTTP errors don't
+                self.breakers.record_failure(hotkey)
+            return None
+        status_code = response.status_code
+        try:
+            response = response.json()
+        except Exception as e:
+            response = {"error": str(e)}
+
+        if status_code == 200:
+            print(f"Received response from validator {hotkey}", flush=True)
+            output = response
+            self.dispatcher.record_latency(end_time - start_time)
+
+        if hotkey not in self.available_validators:
+            # Removed while the call was in flight: keep the answer, skip its bookkeeping
+            return output
+        self.breakers.record_success(hotkey)
+        validator_counter = validator.setdefault(
+            "counter", {}
+        )
+        today_counter = validator_counter.setdefault(
+            str(date.today()), {"success": 0, "failure": 0}
+        )
+        outcome = "success" if output else "failure"
+        today_counter[outcome] += 1
+        self.scorer.record(hotkey, model, end_time - start_time, bool(output))
+        # Persisted with the validator document so scores survive restarts
+        validator["scorer"] = self.scorer.export(hotkey)
+        if not await self.dbhandler.writer.wait_for_capacity():
+            # Only stats, not worth holding up the request for
+            self.dbhandler.writer.dropped("validator_counter")
+            return output
+        try:
+            self.dbhandler.writer.increment(
+                CollectionName.VALIDATORS.value,
+                hotkey,
+                {f"counter.{date.today()}.{outcome}": 1},
+                {"scorer": validator["scorer"]},
+            )
+        except Exception as e:
+            print(f"Failed to update validator - MongoDB: {e}", flush=True)
+        return output
 
-        while True:
-            print("Rechecking validators", flush=True)
-            threads = []
-            hotkeys = list(self.available_validators.keys())
-            for hotkey in hotkeys:
-                thread = Thread(target=check_validator, args=(hotkey,))
-                thread.start()
-            for thread in threads:
-                thread.join()
-            print("Total validators:", len(self.available_validators), flush=True)
-            # update validators to mongodb
-            for hotkey in list(self.available_validators.keys()):
-                self.dbhandler.validators_collection.update_one(
-                    {"_id": hotkey}, {"$set": self.available_validators[hotkey]}
-                )
-            time.sleep(60 * 5)
+    async def probe_validator(self, hotkey: str) -> bool:
+        try:
+            response = await self.http_pool.post_validator(
+                self.available_validators[hotkey]["generate_endpoint"],
+                json=self.recheck_request,
+                timeout=8,
+            )
+            response.raise_for_status()
+            print(f"Validator {hotkey} probe succeeded", flush=True)
+            return True
+        except Exception as e:
+            print(f"Validator {hotkey} probe failed: {e}", flush=True)
+            return False
+
+    def record_probe(self, hotkey: str, ok: bool, latency: float) -> None:
+        validator = self.available_validators.get(hotkey)
+        if validator is None:
+            return
+        if ok:
+            self.breakers.record_success(hotkey)
+        else:
+            self.breakers.record_failure(hotkey)
+        self.scorer.record_health(hotkey, latency, ok)
+        if validator.get("is_active") != ok:
+            print(f"Validator {hotkey} is now {'active' if ok else 'inactive'}", flush=True)
+            validator["is_active"] = ok
+            self.publish_snapshot()
 
     async def get_validators(self) -> List:
         return list(self.available_validators.keys())
 
     async def get_model_classification(self, model_name: str, prompt: str, classifier_url: str) -> str:
         if model_name == "SuperEnsemble":
-            try:
-                response = requests.post(classifier_url, json={"prompt": prompt},timeout=10)
-                if response.status_code == 200:
-                    result = response.json()
-                    return STYLE_TO_MODEL_MAPPING[result['category']]
-                else:
-                    print(f"Classification error: {response.status_code}")
-                    return "OpenGeneral"
-            except Exception as e:
-                print(f"Exception in classification: {str(e)}")
-                return "OpenGeneral"
+            return await self.classifier.classify(prompt, classifier_url)
         return model_name
 
     async def txt2img_api(self, request: Request, data: TextToImage, classifier_url: str):
@@ -374,7 +661,7 @@ class ImageGenerationService:
         if seed == 0:
             seed = random.randint(0, 1000000)
         advanced_params = data.advanced_params
-        ratio_to_size = self.dbhandler.model_config.find_one({"name": "ratio-to-size"})["data"]
+        ratio_to_size = self.config.ratio_to_size
         if aspect_ratio not in ratio_to_size:
             raise HTTPException(status_code=400, detail="Aspect ratio not found")
         if model_name not in self.model_list:
@@ -408,23 +695,41 @@ class ImageGenerationService:
         print(generate_data, flush=True)
         for key, value in default_params.items():
             generate_data["pipeline_params"][key] = value
-        output = await self.generate(Prompt(**generate_data))
+        # DallE returns a short-lived image URL, not worth caching
+        output = await self.generate(
+            Prompt(**generate_data), cacheable=data.seed > 0 and model_name != "DallE", request=request
+        )
         if model_name == "DallE":
             print(output, flush=True)
-            image_url = output["response_dict"]["url"]
-            image = Image.open(requests.get(image_url, stream=True).raw)
-            base64_image = pil_image_to_base64(image)
-            output["image"] = base64_image
+            output["image"] = await self.fetch_dalle_image(request, output["response_dict"]["url"])
 
         return output
 
-    async def img2img_api(self, request: Request, data: ImageToImage):
+    async def fetch_dalle_image(self, request: Request, image_url: str) -> str:
+        try:
+            image = await self.http_pool.fetch(
+                image_url, DALLE_MAX_IMAGE_BYTES, timeout=DALLE_FETCH_TIMEOUT
+            )
+        except ResponseTooLarge as e:
+            print(f"DallE image rejected: {e}", flush=True)
+            raise HTTPException(status_code=502, detail="Generated image is too large")
+        except httpx.HTTPError as e:
+            print(f"Failed to fetch DallE image: {e}", flush=True)
+            raise HTTPException(status_code=502, detail="Failed to fetch generated image")
+        if negotiate_image_format(request) is not None:
+            # image_response serves these bytes as they are, or converts them if the client wants another format
+            return base64.b64encode(image).decode("utf-8")
+        # JSON clients have always received JPEG, transcoding (if needed at all) stays off the event loop
+        return await self.image_executor.run(image_to_base64, image, "JPEG")
+
+    async def img2img_api(self, request: Request, data: ImageToImage, image: Optional[bytes] = None):
         api_key = request.headers.get("API_KEY")
         prompt = data.prompt
         model_name = data.model_name
         negative_prompt = data.negative_prompt
         seed = data.seed
-        conditional_image = data.conditional_image
+        # Raw bytes when the client uploaded the image, base64 from the JSON body otherwise
+        conditional_image = image if image is not None else data.conditional_image
 
         if seed == 0:
             seed = random.randint(0, 1000000)
@@ -437,9 +742,8 @@ class ImageGenerationService:
                 status_code=404, detail="Model does not support img2img pipeline"
             )
         default_params = self.model_list[model_name].get("default_params", {})
-        conditional_image: Image.Image = self.base64_to_pil_image(conditional_image)
-        conditional_image = self.resize_divisible(conditional_image, 1024, 16)
-        conditional_image = self.pil_image_to_base64(conditional_image)
+        check_image_size(conditional_image)
+        conditional_image = await self.image_executor.preprocess(conditional_image, True, 1024, 16)
 
         generate_data = {
             "key": api_key,
@@ -457,15 +761,16 @@ class ImageGenerationService:
         for key, value in default_params.items():
             generate_data["pipeline_params"][key] = value
 
-        return await self.generate(Prompt(**generate_data))
+        return await self.generate(Prompt(**generate_data), cacheable=data.seed > 0, request=request)
 
-    async def instantid_api(self, request: Request, data: ImageToImage):
+    async def instantid_api(self, request: Request, data: ImageToImage, image: Optional[bytes] = None):
         api_key = request.headers.get("API_KEY")
         prompt = data.prompt
         model_name = data.model_name
         negative_prompt = data.negative_prompt
         seed = data.seed
-        conditional_image = data.conditional_image
+        # Raw bytes when the client uploaded the image, base64 from the JSON body otherwise
+        conditional_image = image if image is not None else data.conditional_image
 
         if seed == 0:
             seed = random.randint(0, 1000000)
@@ -479,9 +784,8 @@ class ImageGenerationService:
             )
         default_params = self.model_list[model_name].get("default_params", {})
 
-        conditional_image: Image.Image = self.base64_to_pil_image(conditional_image)
-        conditional_image = self.resize_divisible(conditional_image, 1024, 16)
-        conditional_image = self.pil_image_to_base64(conditional_image)
+        check_image_size(conditional_image)
+        conditional_image = await self.image_executor.preprocess(conditional_image, True, 1024, 16)
 
         generate_data = {
             "key": api_key,
@@ -498,20 +802,21 @@ class ImageGenerationService:
         for key, value in default_params.items():
             generate_data["pipeline_params"][key] = value
 
-        return await self.generate(Prompt(**generate_data))
+        return await self.generate(Prompt(**generate_data), cacheable=data.seed > 0, request=request)
 
-    async def controlnet_api(self, request: Request, data: ImageToImage):
+    async def controlnet_api(self, request: Request, data: ImageToImage, image: Optional[bytes] = None):
         api_key = request.headers.get("API_KEY")
         prompt = data.prompt
         model_name = data.model_name
         negative_prompt = data.negative_prompt
         seed = data.seed
-        conditional_image = data.conditional_image
+        # Raw bytes when the client uploaded the image, base64 from the JSON body otherwise
+        conditional_image = image if image is not None else data.conditional_image
 
         if seed == 0:
             seed = random.randint(0, 1000000)
         advanced_params = data.advanced_params
-        model_list = self.dbhandler.model_config.find_one({"name": "model_list"})["data"]
+        model_list = self.model_list
         if model_name not in model_list:
             raise HTTPException(status_code=404, detail="Model not found")
         supporting_pipelines = model_list[model_name].get("supporting_pipelines", [])
@@ -521,9 +826,8 @@ class ImageGenerationService:
             )
         default_params = model_list[model_name].get("default_params", {})
 
-        conditional_image: Image.Image = self.base64_to_pil_image(conditional_image)
-        conditional_image = self.resize_divisible(conditional_image, 1024, 16)
-        conditional_image = self.pil_image_to_base64(conditional_image)
+        check_image_size(conditional_image)
+        conditional_image = await self.image_executor.preprocess(conditional_image, True, 1024, 16)
 
         generate_data = {
             "key": api_key,
@@ -540,20 +844,21 @@ class ImageGenerationService:
         for key, value in default_params.items():
             generate_data["pipeline_params"][key] = value
 
-        return await self.generate(Prompt(**generate_data))
+        return await self.generate(Prompt(**generate_data), cacheable=data.seed > 0, request=request)
 
-    async def upscale_api(self, request: Request, data: ImageToImage):
+    async def upscale_api(self, request: Request, data: ImageToImage, image: Optional[bytes] = None):
         api_key = request.headers.get("API_KEY")
         prompt = data.prompt
         model_name = data.model_name
         negative_prompt = data.negative_prompt
         seed = data.seed
-        conditional_image = data.conditional_image
+        # Raw bytes when the client uploaded the image, base64 from the JSON body otherwise
+        conditional_image = image if image is not None else data.conditional_image
 
         if seed == 0:
             seed = random.randint(0, 1000000)
         advanced_params = data.advanced_params
-        model_list = self.dbhandler.model_config.find_one({"name": "model_list"})["data"]
+        model_list = self.model_list
         if model_name not in model_list:
             raise HTTPException(status_code=404, detail="Model not found")
         supporting_pipelines = model_list[model_name].get("supporting_pipelines", [])
@@ -564,8 +869,8 @@ class ImageGenerationService:
             )
         default_params = model_list[model_name].get("default_params", {})
 
-        conditional_image: Image.Image = self.base64_to_pil_image(conditional_image)
-        conditional_image = self.pil_image_to_base64(conditional_image)
+        check_image_size(conditional_image)
+        conditional_image = await self.image_executor.preprocess(conditional_image, False)
 
         generate_data = {
             "key": api_key,
@@ -582,14 +887,15 @@ class ImageGenerationService:
         for key, value in default_params.items():
             generate_data["pipeline_params"][key] = value
 
-        return await self.generate(Prompt(**generate_data))
+        return await self.generate(Prompt(**generate_data), cacheable=data.seed > 0, request=request)
     
     async def chat_completions(self, request: Request, data: ChatCompletion):
         api_key = request.headers.get("API_KEY") or request.headers.get("Authorization").replace("Bearer ", "")
-        model_list = self.dbhandler.model_config.find_one({"name": "model_list"})["data"]
+        model_list = self.model_list
         if data.model not in model_list:
             raise HTTPException(status_code=404, detail="Model not found")
-        messages_str = self.tokenizers[data.model].apply_chat_template(data.messages, tokenize=False)
+        tokenizer = await self.get_tokenizer(data.model)
+        messages_str = tokenizer.apply_chat_template(data.messages, tokenize=False)
         print(f"Chat message str: {messages_str}", flush=True)
         generate_data = {
             "key": api_key,
@@ -601,30 +907,36 @@ class ImageGenerationService:
                 "max_tokens": data.max_tokens
             }
         }
-        response = await self.generate(TextPrompt(**generate_data))
+        response = await self.generate(TextPrompt(**generate_data), request=request)
         return response['prompt_output']
 
+    async def image_response(self, request: Request, output):
+        # Raw image bytes for clients sending Accept: image/*, the JSON/base64 contract otherwise
+        negotiated = negotiate_image_format(request)
+        if negotiated is None or not isinstance(output, dict) or not output.get("image"):
+            return output
+        data, format = await self.image_executor.run(encode_image, output["image"], negotiated[1])
+        return Response(content=data, media_type=media_type_for(format))
+
+    async def get_tokenizer(self, model_name: str):
+        tokenizer = self.tokenizers.get(model_name)
+        if tokenizer is not None:
+            return tokenizer
+        repo = self.config.tokenizers.get(model_name)
+        if not repo:
+            raise HTTPException(status_code=404, detail="Tokenizer not found")
+        lock = self._tokenizer_locks.setdefault(model_name, asyncio.Lock())
+        async with lock:
+            if model_name not in self.tokenizers:
+                print(f"Loading tokenizer {repo} for {model_name}", flush=True)
+                self.tokenizers[model_name] = await asyncio.to_thread(load_tokenizer, repo)
+        return self.tokenizers[model_name]
+
     def base64_to_pil_image(self, base64_image):
-        image = base64.b64decode(base64_image)
-        image = io.BytesIO(image)
-        image = Image.open(image)
-        return image
+        return image_processing.base64_to_pil_image(base64_image)
 
     def pil_image_to_base64(self, image: Image.Image, format="JPEG") -> str:
-        if format not in ["JPEG", "PNG"]:
-            format = "JPEG"
-        image_stream = io.BytesIO()
-        image.save(image_stream, format=format)
-        base64_image = base64.b64encode(image_stream.getvalue()).decode("utf-8")
-        return base64_image
+        return image_processing.pil_image_to_base64(image, format)
 
     def resize_divisible(self, image, max_size=1024, divisible=16):
-        W, H = image.size
-        if W > H:
-            W, H = max_size, int(max_size * H / W)
-        else:
-            W, H = int(max_size * W / H), max_size
-        W = W - W % divisible
-        H = H - H % divisible
-        image = image.resize((W, H))
-        return image
+        return image_processing.resize_divisible(image, max_size, divisible)
@@ -0,0 +1,56 @@
+import os
+import time
+
+import httpx
+from prometheus_client import Histogram
+
+from constants import STYLE_TO_MODEL_MAPPING
+from utils.common import normalize_prompt
+from utils.http_pool import HTTPClientPool
+from utils.ttl_cache import TTLCache
+
+CLASSIFIER_TIMEOUT = float(os.getenv("CLASSIFIER_TIMEOUT", 2))
+CLASSIFIER_CACHE_SIZE = int(os.getenv("CLASSIFIER_CACHE_SIZE", 10000))
+CLASSIFIER_CACHE_TTL = float(os.getenv("CLASSIFIER_CACHE_TTL", 60 * 60))
+FALLBACK_MODEL = "OpenGeneral"
+
+CLASSIFIER_LATENCY = Histogram(
+    "prompt_classifier_request_seconds",
+    "Latency of SuperEnsemble prompt classifier calls",
+    ["outcome"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5),
+)
+
+
+class PromptClassifier:
+    def __init__(self, http_pool: HTTPClientPool):
+        self.http_pool = http_pool
+        self.cache = TTLCache("prompt_classifier", CLASSIFIER_CACHE_SIZE, CLASSIFIER_CACHE_TTL)
+
+    async def classify(self, prompt: str, classifier_url: str) -> str:
+        # Model for a SuperEnsemble prompt, falls back to OpenGeneral rather than failing the request
+        key = normalize_prompt(prompt)
+        model_name = self.cache.get(key)
+        if model_name is not None:
+            return model_name
+        start_time = time.perf_counter()
+        outcome = "error"
+        try:
+            response = await self.http_pool.post(
+                classifier_url, json={"prompt": prompt}, timeout=CLASSIFIER_TIMEOUT
+            )
+            if response.status_code != 200:
+                print(f"Classification error: {response.status_code}", flush=True)
+                return FALLBACK_MODEL
+            model_name = STYLE_TO_MODEL_MAPPING[response.json()["category"]]
+            outcome = "success"
+        except Exception as e:
+            if isinstance(e, httpx.TimeoutException):
+                outcome = "timeout"
+            print(f"Exception in classification: {str(e)}", flush=True)
+            return FALLBACK_MODEL
+        finally:
+            CLASSIFIER_LATENCY.labels(outcome=outcome).observe(time.perf_counter() - start_time)
+        # Only real answers are cached, a fallback is retried on the next request
+        self.cache.set(key, model_name)
+        return model_name
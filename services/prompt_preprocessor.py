@@ -0,0 +1,87 @@
+import asyncio
+import os
+from typing import Tuple
+
+from prometheus_client import Counter
+
+from utils.common import normalize_prompt
+from utils.http_pool import HTTPClientPool
+from utils.ttl_cache import TTLCache
+
+PROMPT_CHECK_URL = os.getenv("PROMPT_CHECK_URL", "https://api.midjourneyapi.xyz/mj/v2/validation")
+PROMPT_EXPANSION_URL = os.getenv("PROMPT_EXPANSION_URL", "http://213.173.102.215:10354/api/prompt_expansion")
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", 10000))
+PROMPT_CHECK_CACHE_TTL = float(os.getenv("PROMPT_CHECK_CACHE_TTL", 60 * 60))
+PROMPT_EXPANSION_CACHE_TTL = float(os.getenv("PROMPT_EXPANSION_CACHE_TTL", 60 * 60))
+# Start dispatching to validators while moderation is still running, cancelled if it rejects
+SPECULATIVE_DISPATCH = os.getenv("SPECULATIVE_DISPATCH", "false").lower() == "true"
+
+SPECULATIVE_DISPATCHES = Counter(
+    "speculative_dispatch_total",
+    "Validator dispatches started before prompt moderation finished, by moderation outcome",
+    ["outcome"],
+)
+
+
+class PromptPreprocessor:
+    def __init__(self, http_pool: HTTPClientPool):
+        self.http_pool = http_pool
+        self.check_cache = TTLCache("prompt_check", PROMPT_CACHE_SIZE, PROMPT_CHECK_CACHE_TTL)
+        self.expansion_cache = TTLCache("prompt_expansion", PROMPT_CACHE_SIZE, PROMPT_EXPANSION_CACHE_TTL)
+
+    async def check(self, prompt: str) -> Tuple[bool, str]:
+        key = normalize_prompt(prompt)
+        verdict = self.check_cache.get(key)
+        if verdict is not None:
+            return verdict
+        try:
+            response = await self.http_pool.post(PROMPT_CHECK_URL, json={"prompt": prompt})
+            response = response.json()
+            print(response, flush=True)
+            if not response["ErrorMessage"]:
+                verdict = (True, "")
+            else:
+                print(response["ErrorMessage"], flush=True)
+                verdict = (False, response["ErrorMessage"])
+        except Exception as e:
+            # Fail open, and don't cache it so the next request asks again
+            print(e, flush=True)
+            return True, ""
+        self.check_cache.set(key, verdict)
+        return verdict
+
+    async def expand(self, prompt: str) -> str:
+        # Keyed on the exact text: unlike a verdict, the rewrite depends on case and spacing
+        key = prompt
+        expanded = self.expansion_cache.get(key)
+        if expanded is not None:
+            return expanded
+        try:
+            response = await self.http_pool.post(PROMPT_EXPANSION_URL, json={"prompt": prompt})
+            if response.status_code != 200:
+                return prompt
+            expanded = response.json()
+        except Exception as e:
+            print(e, flush=True)
+            return prompt
+        self.expansion_cache.set(key, expanded)
+        return expanded
+
+    async def prepare(self, prompt: str, use_expansion: bool) -> Tuple["asyncio.Future", str]:
+        # Starts moderation, expands the prompt while it runs and returns the
+        # (possibly still running) moderation task with the prompt to send
+        moderation = asyncio.ensure_future(self.check(prompt))
+        if not use_expansion:
+            return moderation, prompt
+        expansion = asyncio.ensure_future(self.expand(prompt))
+        try:
+            done, _ = await asyncio.wait({moderation, expansion}, return_when=asyncio.FIRST_COMPLETED)
+            if moderation in done and not moderation.result()[0]:
+                # Rejected, the expansion isn't needed
+                expansion.cancel()
+                return moderation, prompt
+            return moderation, await expansion
+        except BaseException:
+            moderation.cancel()
+            expansion.cancel()
+            raise
@@ -1,10 +1,16 @@
+import asyncio
+import base64
+import json
 import os
 import uuid
+from typing import Optional
 from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
 import stripe
-from utils.common import check_password, hash_password
+from utils.common import check_password, hash_password, usage_aggregate_fields, usage_bucket_id, usage_bucket_start
 from utils.data_types import ChangePasswordDataType, EmailDataType, UserSigninInfo, APIKey
-from constants import LOGS_ACTION
+from utils.rate_limit import DEFAULT_TIER
+from constants import LOGS_ACTION, CollectionName
 from datetime import datetime, timedelta, timezone
 from bson import ObjectId
 import jwt
@@ -14,11 +20,16 @@ stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_PRODUCT_ID = os.getenv("STRIPE_PRODUCT_ID")
 STRIPE_PRICE_ID = os.getenv("STRIPE_PRICE_ID")
 SECRET_KEY = os.getenv("SECRET_KEY")
+# Number of recent usage events returned with the user info
+USAGE_HISTORY_LIMIT = int(os.getenv("USAGE_HISTORY_LIMIT", 100))
+LOGS_PAGE_LIMIT = 1000
+LOGS_DEFAULT_PAGE_SIZE = 100
+LOGS_PROJECTION = {"action": 1, "details": 1, "api_key": 1, "status": 1, "model": 1, "cost": 1, "timestamp": 1}
+LOGS_SORT = [("timestamp", 1), ("_id", 1)]
 
 class UserService:
     def __init__(self, dbhandler):
         self.dbhandler = dbhandler
-        self.auth_keys = self.dbhandler.get_auth_keys()
 
     # Admin methods
     async def admin_signin(self, request: Request):  # Changed to async
@@ -46,13 +57,12 @@ class UserService:
     async def admin_delete_user(self, request: Request):
         data = await request.json()  # Await the coroutine
         _id = data.get("_id")
-        userInfo = self.dbhandler.auth_keys_collection.find_one({"_id": _id})
+        userInfo = await self.dbhandler.aio.auth_keys_collection.find_one({"_id": _id})
         if userInfo:
-            self.dbhandler.logs_collection.delete_many({"api_key": _id})
-            api_keys = userInfo.get("api_keys", [])
-            for api_key in api_keys:
-                self.dbhandler.logs_collection.delete_many({"api_key": api_key["key"]})
-            self.dbhandler.auth_keys_collection.delete_one({"_id": _id})
+            api_keys = [_id] + [api_key["key"] for api_key in userInfo.get("api_keys", [])]
+            await self.dbhandler.aio.logs_collection.delete_many({"api_key": {"$in": api_keys}})
+            await self.dbhandler.aio.auth_keys_collection.delete_one({"_id": _id})
+            self.dbhandler.auth_key_index.remove(_id)
             return {"message": "User deleted successfully"}
         else:
             raise HTTPException(status_code=400, detail="User does not exist!")
@@ -89,9 +99,11 @@ class UserService:
                 "request_count": 0,
                 "password": hash_password(data.password),
                 "credit": 5,
+                "tier": DEFAULT_TIER,
                 "created_date": datetime.utcnow(),
+                "updated_at": datetime.utcnow(),
                 "api_keys": [{"key": str(uuid.uuid4()), "created": datetime.utcnow()}],
-                "usage": [],
+                "usage_daily": {},
                 "balance_history": []
             }
         )
@@ -99,6 +111,7 @@ class UserService:
             {"_id": user_id}, {"password": 0}
         )
         if created_user:
+            self.dbhandler.auth_key_index.refresh(user_id)
             created_user["_id"] = str(created_user["_id"])
             self.log_user_activity(created_user["_id"], LOGS_ACTION.SIGNUP.value, "Registered", 200, "", 0)
         return created_user
@@ -107,10 +120,13 @@ class UserService:
         data = await request.json()
         _id = data.get("_id")
         
-        userInfo = self.dbhandler.auth_keys_collection.find_one({"_id": _id})
+        userInfo = await self.dbhandler.aio.auth_keys_collection.find_one({"_id": _id})
         if userInfo:
             new_password = ''.join(random.choices(string.ascii_letters + string.digits + string.punctuation, k=12))  # Generate a secure random password
-            self.dbhandler.auth_keys_collection.update_one({"_id": _id}, {"$set": {"password": hash_password(new_password)}})
+            # bcrypt is deliberately slow, keep it off the event loop
+            hashed = await asyncio.to_thread(hash_password, new_password)
+            await self.dbhandler.aio.auth_keys_collection.update_one({"_id": _id}, {"$set": {"password": hashed, "updated_at": datetime.utcnow()}})
+            await self.dbhandler.auth_key_index.arefresh(_id)
             return {"message": "Password reset successfully", "password": new_password}
         else:
             raise HTTPException(status_code=400, detail="User does not exist!")
@@ -119,10 +135,10 @@ class UserService:
         userInfo = self.dbhandler.auth_keys_collection.find_one({"email": data.email})
         if userInfo:
             if check_password(data.oldPassword, userInfo["password"]):
-                self.dbhandler.auth_keys_collection.update_one({"email": data.email}, {"$set": {"password": hash_password(data.newPassword)}})
-                self.auth_keys = self.dbhandler.get_auth_keys()
+                self.dbhandler.auth_keys_collection.update_one({"email": data.email}, {"$set": {"password": hash_password(data.newPassword), "updated_at": datetime.utcnow()}})
+                self.dbhandler.auth_key_index.refresh(userInfo["_id"])
                 api_key = request.headers.get("API_KEY")
-                user_info = self.auth_keys[api_key]
+                user_info = self.dbhandler.auth_key_index.get(api_key)
                 if user_info:
                     user_info.pop("password", None)
                     user_info.pop("temp_id", None)
@@ -133,12 +149,12 @@ class UserService:
         else:
             raise HTTPException(status_code=400, detail="User does not exist!")
 
-    def get_user_info(self, request: Request):
+    async def get_user_info(self, request: Request):
         try:
             api_key = request.headers.get("API_KEY")
-            self.auth_keys = self.dbhandler.get_auth_keys()
-            user_info = self.auth_keys[api_key]
+            user_info = await self.dbhandler.auth_key_index.aget(api_key)
             if user_info:
+                user_info["usage"] = await self.get_recent_usage(user_info["temp_id"])
                 user_info.pop("password", None)
                 user_info.pop("temp_id", None)
                 return {
@@ -155,14 +171,14 @@ class UserService:
     def add_api_key(self, request: Request):
         try:
             api_key = request.headers.get("API_KEY")
-            self.auth_keys = self.dbhandler.get_auth_keys()
-            key_id = self.auth_keys[api_key]["temp_id"]
+            key_id = self.dbhandler.auth_key_index.get(api_key)["temp_id"]
             new_api_key = {"key": str(uuid.uuid4()), "created": datetime.utcnow()}
             self.dbhandler.auth_keys_collection.update_one(
-                {"_id": key_id}, {"$push": {"api_keys": new_api_key}}
+                {"_id": key_id},
+                {"$push": {"api_keys": new_api_key}, "$set": {"updated_at": datetime.utcnow()}},
             )
-            self.auth_keys = self.dbhandler.get_auth_keys()
-            user_info = self.auth_keys[api_key]
+            self.dbhandler.auth_key_index.refresh(key_id)
+            user_info = self.dbhandler.auth_key_index.get(api_key)
             if user_info:
                 user_info.pop("password", None)
                 self.log_user_activity(api_key, LOGS_ACTION.CREATE_API_KEY.value, "Added a new API key", 200, "", 0)
@@ -182,17 +198,17 @@ class UserService:
     def delete_api_key(self, request: Request, api_key_data: str):
         try:
             api_key = request.headers.get("API_KEY")
-            self.auth_keys = self.dbhandler.get_auth_keys()
-            key_id = self.auth_keys[api_key]["temp_id"]
+            key_id = self.dbhandler.auth_key_index.get(api_key)["temp_id"]
             result = self.dbhandler.auth_keys_collection.update_one(
-                {"_id": key_id}, {"$pull": {"api_keys": {"key": api_key_data}}}
+                {"_id": key_id},
+                {"$pull": {"api_keys": {"key": api_key_data}}, "$set": {"updated_at": datetime.utcnow()}},
             )
             if result.modified_count == 0:
                 raise HTTPException(
                     status_code=404, detail="API key not found or no modification made"
                 )
-            self.auth_keys = self.dbhandler.get_auth_keys()
-            user_info = self.auth_keys[api_key]
+            self.dbhandler.auth_key_index.refresh(key_id)
+            user_info = self.dbhandler.auth_key_index.get(api_key)
             if user_info:
                 user_info.pop("password", None)
                 self.log_user_activity(api_key, LOGS_ACTION.DELETE_API_KEY.value, "Deleted API key", 200, "", 0)
@@ -209,22 +225,117 @@ class UserService:
                 status_code=500, detail="An error occurred while deleting api key"
             )
 
-    def get_logs(self, request: Request):
+    def get_logs(self, request: Request, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                 limit: Optional[int] = None, action: Optional[str] = None, cursor: Optional[str] = None):
+        query = self._logs_query(request, since, until, action, cursor)
+        # Without limit or cursor the caller gets every matching log, as before pagination existed
+        paginated = limit is not None or cursor is not None
+        if paginated:
+            limit = max(1, min(limit or LOGS_DEFAULT_PAGE_SIZE, LOGS_PAGE_LIMIT))
         try:
-            api_key = request.headers.get("API_KEY")
-            self.auth_keys = self.dbhandler.get_auth_keys()
-            userInfo = self.auth_keys[api_key]
-            keys = [api_key] + [key["key"] for key in userInfo["api_keys"]]
-            logs = self.dbhandler.logs_collection.find({"api_key": {"$in": keys}})
-            logs_list = list(logs)
-            return [{**log, "_id": str(log["_id"])} for log in logs_list]
+            logs = self.dbhandler.logs_collection.find(query, LOGS_PROJECTION).sort(LOGS_SORT)
+            logs = list(logs.limit(limit) if paginated else logs)
         except Exception as e:
             raise HTTPException(
                 status_code=500, detail="An error occurred while getting logs"
             )
+        next_cursor = None
+        if paginated and len(logs) == limit:
+            last = logs[-1]
+            next_cursor = base64.urlsafe_b64encode(
+                f"{last['timestamp'].isoformat()}|{last['_id']}".encode()
+            ).decode()
+        return {
+            "logs": [{**log, "_id": str(log["_id"])} for log in logs],
+            "next_cursor": next_cursor,
+        }
+
+    def stream_logs(self, request: Request, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                    action: Optional[str] = None, cursor: Optional[str] = None):
+        # NDJSON export, the Mongo cursor is consumed batch by batch so memory stays flat
+        query = self._logs_query(request, since, until, action, cursor)
+        logs = self.dbhandler.logs_collection.find(query, LOGS_PROJECTION).sort(LOGS_SORT).batch_size(500)
+
+        def lines():
+            with logs:
+                for log in logs:
+                    log["_id"] = str(log["_id"])
+                    yield json.dumps(log, default=str) + "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    def _logs_query(self, request: Request, since, until, action, cursor):
+        api_key = request.headers.get("API_KEY")
+        userInfo = self.dbhandler.auth_key_index.get(api_key)
+        if not userInfo:
+            raise HTTPException(status_code=404, detail="User not found")
+        keys = [api_key] + [key["key"] for key in userInfo.get("api_keys", [])]
+        query = {"api_key": {"$in": keys}}
+        timestamp = {}
+        if since:
+            timestamp["$gte"] = since
+        if until:
+            timestamp["$lt"] = until
+        if timestamp:
+            query["timestamp"] = timestamp
+        if action:
+            query["action"] = action
+        if cursor:
+            try:
+                last_timestamp, last_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+                last_timestamp = datetime.fromisoformat(last_timestamp)
+                last_id = ObjectId(last_id)
+            except Exception:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            query = {"$and": [query, {"$or": [
+                {"timestamp": {"$gt": last_timestamp}},
+                {"timestamp": last_timestamp, "_id": {"$gt": last_id}},
+            ]}]}
+        return query
+
+    async def get_recent_usage(self, account_id, limit=USAGE_HISTORY_LIMIT):
+        buckets = (
+            self.dbhandler.aio.usage_collection.find(
+                {"account_id": account_id}, {"events": {"$slice": -limit}}
+            )
+            .sort("start", -1)
+            .limit(limit)
+        )
+        events = []
+        async for bucket in buckets:
+            events = bucket.get("events", [])[-(limit - len(events)):] + events
+            if len(events) >= limit:
+                break
+        return events
+
+    def record_usage(self, account_id, api_key, model_name, pipeline_type, cost):
+        now = datetime.utcnow()
+        bucket_id = usage_bucket_id(account_id, now)
+        self.dbhandler.writer.push(
+            CollectionName.USAGE.value,
+            bucket_id,
+            "events",
+            {
+                "api_key": api_key,
+                "model_name": model_name,
+                "pipeline_type": pipeline_type,
+                "credit_cost": cost,
+                "timestamp": now,
+            },
+            {"account_id": account_id, "start": usage_bucket_start(now)},
+            upsert=True,
+        )
+        self.dbhandler.writer.increment(CollectionName.USAGE.value, bucket_id, {"count": 1}, upsert=True)
+        self.dbhandler.writer.increment(
+            CollectionName.AUTH_KEYS.value,
+            account_id,
+            usage_aggregate_fields(now, model_name, cost),
+            {"updated_at": now},
+        )
 
     def log_user_activity(self, api_key, action, details, status, model, cost):
-        self.dbhandler.logs_collection.insert_one(
+        self.dbhandler.writer.insert(
+            CollectionName.LOGS.value,
             {
                 "action": action,
                 "details": details,
@@ -235,14 +346,13 @@ class UserService:
                 "timestamp": datetime.utcnow(),
             }
         )
-    def add_balance(self, email, amount):
-        userInfo = self.dbhandler.auth_keys_collection.find_one({"email": email})
+    async def add_balance(self, email, amount):
+        userInfo = await self.dbhandler.aio.auth_keys_collection.find_one({"email": email})
         if userInfo:
-            # Update the credit
-            new_credit = userInfo.get("credit", 0) + amount
-            self.dbhandler.auth_keys_collection.update_one(
+            # Update the credit, $inc so it can't race with in-flight reservations
+            await self.dbhandler.aio.auth_keys_collection.update_one(
                 {"email": email},
-                {"$set": {"credit": new_credit}}
+                {"$inc": {"credit": amount}, "$set": {"updated_at": datetime.utcnow()}}
             )
 
             # Prepare balance history entry
@@ -253,16 +363,18 @@ class UserService:
 
             # Update balance_history
             if "balance_history" not in userInfo:
-                self.dbhandler.auth_keys_collection.update_one(
+                await self.dbhandler.aio.auth_keys_collection.update_one(
                     {"email": email},
                     {"$set": {"balance_history": [balance_entry]}}
                 )
             else:
-                self.dbhandler.auth_keys_collection.update_one(
+                await self.dbhandler.aio.auth_keys_collection.update_one(
                     {"email": email},
                     {"$push": {"balance_history": balance_entry}}
                 )
 
+            await self.dbhandler.auth_key_index.arefresh(userInfo["_id"])
+
             # Log the balance addition
             self.log_user_activity(userInfo["_id"], LOGS_ACTION.ADD_BALANCE.value, f"Added balance: {amount}", 200, "", 0)
         else:
@@ -280,7 +392,8 @@ class UserService:
                 if session.get("payment_status") != "paid":
                     return {"message": "Payment not completed"}, 400
                 try:
-                    line_items = stripe.checkout.Session.list_line_items(session_id)
+                    # The Stripe SDK is blocking
+                    line_items = await asyncio.to_thread(stripe.checkout.Session.list_line_items, session_id)
 
                     email = session.get("customer_details").get("email")  # Assuming you have this in the session
                     for item in line_items.data:
@@ -288,7 +401,7 @@ class UserService:
                         price_id = item.price.id
 
                         if product_id == STRIPE_PRODUCT_ID and price_id == STRIPE_PRICE_ID:
-                            self.add_balance(email, item.amount_total / 100)
+                            await self.add_balance(email, item.amount_total / 100)
                             print(f"Checkout session completed. Email: {email}, Amount: {item.amount_total}")
                             return {"message": "checkout session completed"}
                 except stripe.error.InvalidRequestError as e:
@@ -0,0 +1,151 @@
+import os
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+# stake | ewma
+VALIDATOR_SCORER = os.getenv("VALIDATOR_SCORER", "ewma")
+# p2c (power of two choices) | weighted
+VALIDATOR_SELECTION = os.getenv("VALIDATOR_SELECTION", "p2c")
+SCORER_EWMA_ALPHA = float(os.getenv("SCORER_EWMA_ALPHA", 0.2))
+# Stats decay back towards the prior when a validator hasn't been used for a while
+SCORER_HALF_LIFE = float(os.getenv("SCORER_HALF_LIFE", 60 * 30))
+SCORER_STAKE_EXPONENT = float(os.getenv("SCORER_STAKE_EXPONENT", 0.5))
+# Floor relative to the best score so slow validators still get some traffic
+SCORER_MIN_WEIGHT = float(os.getenv("SCORER_MIN_WEIGHT", 0.05))
+SCORER_DEFAULT_LATENCY = 10.0
+SCORER_MIN_MODEL_SAMPLES = 5
+
+ALL_MODELS = "all"
+# Health probe results, kept apart so probe latency doesn't mix with generation latency
+HEALTH = "health"
+
+
+class ValidatorStats:
+    def __init__(self, latency=SCORER_DEFAULT_LATENCY, success_rate=1.0, samples=0, updated_at=0.0):
+        self.latency = latency
+        self.success_rate = success_rate
+        self.samples = samples
+        self.updated_at = updated_at
+
+    def observe(self, latency: float, success: bool) -> None:
+        self._decay()
+        self.latency += SCORER_EWMA_ALPHA * (latency - self.latency)
+        self.success_rate += SCORER_EWMA_ALPHA * (float(success) - self.success_rate)
+        self.samples += 1
+        self.updated_at = time.time()
+
+    def current(self) -> Tuple[float, float]:
+        weight = self._weight()
+        latency = weight * self.latency + (1 - weight) * SCORER_DEFAULT_LATENCY
+        success_rate = weight * self.success_rate + (1 - weight) * 1.0
+        return latency, success_rate
+
+    def _weight(self) -> float:
+        if not self.updated_at:
+            return 0.0
+        return 0.5 ** ((time.time() - self.updated_at) / SCORER_HALF_LIFE)
+
+    def _decay(self) -> None:
+        self.latency, self.success_rate = self.current()
+
+    def to_dict(self) -> Dict:
+        return {
+            "latency": self.latency,
+            "success_rate": self.success_rate,
+            "samples": self.samples,
+            "updated_at": self.updated_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "ValidatorStats":
+        return cls(
+            latency=data.get("latency", SCORER_DEFAULT_LATENCY),
+            success_rate=data.get("success_rate", 1.0),
+            samples=data.get("samples", 0),
+            updated_at=data.get("updated_at", 0.0),
+        )
+
+
+def model_key(model_name: str, pipeline_type: str) -> str:
+    # Stored as a MongoDB field name, so no dots
+    return f"{model_name}|{pipeline_type}".replace(".", "_")
+
+
+class StakeScorer:
+    # Weighted random choice by stake, the original selection policy
+    def pick(self, validators: List[Tuple[str, float]], model: str) -> Tuple[str, float]:
+        stakes = [stake for _, stake in validators]
+        return random.choices(validators, weights=stakes, k=1)[0]
+
+    def record(self, hotkey: str, model: str, latency: float, success: bool) -> None:
+        pass
+
+    def record_health(self, hotkey: str, latency: float, success: bool) -> None:
+        pass
+
+    def load(self, hotkey: str, state: Optional[Dict]) -> None:
+        pass
+
+    def export(self, hotkey: str) -> Dict:
+        return {}
+
+
+class EwmaScorer(StakeScorer):
+    def __init__(self, selection: str = VALIDATOR_SELECTION):
+        self.selection = selection
+        self.stats: Dict[str, Dict[str, ValidatorStats]] = {}
+
+    def record(self, hotkey: str, model: str, latency: float, success: bool) -> None:
+        validator_stats = self.stats.setdefault(hotkey, {})
+        for key in (ALL_MODELS, model):
+            validator_stats.setdefault(key, ValidatorStats()).observe(latency, success)
+
+    def record_health(self, hotkey: str, latency: float, success: bool) -> None:
+        self.stats.setdefault(hotkey, {}).setdefault(HEALTH, ValidatorStats()).observe(latency, success)
+
+    def load(self, hotkey: str, state: Optional[Dict]) -> None:
+        if not state or hotkey in self.stats:
+            return
+        self.stats[hotkey] = {key: ValidatorStats.from_dict(value) for key, value in state.items()}
+
+    def export(self, hotkey: str) -> Dict:
+        return {key: value.to_dict() for key, value in self.stats.get(hotkey, {}).items()}
+
+    def score(self, hotkey: str, stake: float, max_stake: float, model: str) -> float:
+        validator_stats = self.stats.get(hotkey, {})
+        stats = validator_stats.get(model)
+        if stats is None or stats.samples < SCORER_MIN_MODEL_SAMPLES:
+            stats = validator_stats.get(ALL_MODELS, ValidatorStats())
+        latency, success_rate = stats.current()
+        # Recently failing health probes pull the score down, decaying back as they pass again
+        if HEALTH in validator_stats:
+            success_rate *= validator_stats[HEALTH].current()[1]
+        stake_weight = (float(stake) / max_stake) ** SCORER_STAKE_EXPONENT if max_stake > 0 else 1.0
+        return stake_weight * success_rate ** 2 / max(latency, 0.1)
+
+    def pick(self, validators: List[Tuple[str, float]], model: str) -> Tuple[str, float]:
+        if len(validators) == 1:
+            return validators[0]
+        max_stake = max(float(stake) for _, stake in validators)
+        scores = [self.score(hotkey, stake, max_stake, model) for hotkey, stake in validators]
+        floor = max(scores) * SCORER_MIN_WEIGHT
+        scores = [max(score, floor) for score in scores]
+        if self.selection == "p2c":
+            # Sample two candidates by stake, keep the better scoring one
+            stakes = [stake for _, stake in validators]
+            first, second = random.choices(
+                range(len(validators)), weights=stakes if any(stakes) else None, k=2
+            )
+            if first == second:
+                second = random.randrange(len(validators))
+            return validators[first if scores[first] >= scores[second] else second]
+        return random.choices(validators, weights=scores, k=1)[0]
+
+
+def create_scorer(name: str = VALIDATOR_SCORER) -> StakeScorer:
+    if name == "stake":
+        return StakeScorer()
+    if name == "ewma":
+        return EwmaScorer()
+    raise ValueError(f"Unknown validator scorer: {name}")
@@ -0,0 +1,231 @@
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+from bson import ObjectId
+from prometheus_client import Counter, Gauge
+from pymongo.errors import OperationFailure, PyMongoError
+
+AUTH_KEY_INDEX_POLL_INTERVAL = float(os.getenv("AUTH_KEY_INDEX_POLL_INTERVAL", 5))
+AUTH_KEY_INDEX_FULL_RELOAD_INTERVAL = float(os.getenv("AUTH_KEY_INDEX_FULL_RELOAD_INTERVAL", 600))
+
+# Usage history lives in its own collection, legacy documents may still carry the array
+INDEX_PROJECTION = {"usage": 0}
+
+AUTH_KEY_LOOKUPS = Counter(
+    "auth_key_index_lookups_total",
+    "API key lookups served by the in-memory auth key index",
+    ["result"],
+)
+AUTH_KEY_INDEX_SIZE = Gauge(
+    "auth_key_index_keys", "Number of API keys held in the in-memory auth key index"
+)
+AUTH_KEY_INDEX_STALENESS = Gauge(
+    "auth_key_index_staleness_seconds",
+    "Seconds since the auth key index last confirmed it is in sync with MongoDB",
+)
+
+
+def normalize_auth_doc(doc: Dict) -> Dict:
+    # Same shape get_auth_keys() has always returned: string _id, original id in temp_id
+    key = str(doc["_id"]) if isinstance(doc["_id"], ObjectId) else doc["_id"]
+    doc["temp_id"] = doc["_id"]
+    doc["_id"] = key
+    doc.pop("usage", None)
+    doc.setdefault("credit", 5)
+    return doc
+
+
+class AuthKeyIndex:
+    def __init__(self, collection, async_collection=None):
+        self.collection = collection
+        # Used by aget/arefresh so handlers on the event loop never block on a miss
+        self.async_collection = async_collection
+        self._lock = threading.Lock()
+        # account id -> normalized auth doc
+        self._accounts: Dict[str, Dict] = {}
+        # api key (or account id) -> account id
+        self._keys: Dict[str, str] = {}
+        self._last_sync = 0.0
+        self._last_seen_update = None
+        AUTH_KEY_INDEX_STALENESS.set_function(lambda: time.time() - self._last_sync)
+
+    def start(self) -> None:
+        self.load()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def load(self) -> None:
+        accounts = {}
+        keys = {}
+        last_seen_update = None
+        for doc in self.collection.find({}, INDEX_PROJECTION):
+            doc = normalize_auth_doc(doc)
+            accounts[doc["_id"]] = doc
+            for key in self._account_keys(doc):
+                keys[key] = doc["_id"]
+            updated_at = doc.get("updated_at")
+            if updated_at and (last_seen_update is None or updated_at > last_seen_update):
+                last_seen_update = updated_at
+        with self._lock:
+            self._accounts = accounts
+            self._keys = keys
+            if last_seen_update:
+                self._last_seen_update = last_seen_update
+        self._last_sync = time.time()
+        AUTH_KEY_INDEX_SIZE.set(len(keys))
+        print(f"Loaded {len(accounts)} accounts / {len(keys)} keys into auth key index", flush=True)
+
+    def get(self, key: str, lookup: bool = True) -> Optional[Dict]:
+        if not key:
+            return None
+        doc = self._cached(key)
+        if doc is not None or not lookup:
+            return doc
+        # The key may have been created since the last sync, fall back to an indexed lookup
+        doc = self.collection.find_one({"$or": self._key_filters(key)}, INDEX_PROJECTION)
+        if doc is None:
+            return None
+        doc = self.update(doc)
+        return dict(doc)
+
+    async def aget(self, key: str, lookup: bool = True) -> Optional[Dict]:
+        if not key:
+            return None
+        doc = self._cached(key)
+        if doc is not None or not lookup:
+            return doc
+        doc = await self.async_collection.find_one({"$or": self._key_filters(key)}, INDEX_PROJECTION)
+        if doc is None:
+            return None
+        doc = self.update(doc)
+        return dict(doc)
+
+    def _cached(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            account_id = self._keys.get(key)
+            doc = self._accounts.get(account_id) if account_id else None
+        if doc is None:
+            AUTH_KEY_LOOKUPS.labels(result="miss").inc()
+            return None
+        AUTH_KEY_LOOKUPS.labels(result="hit").inc()
+        # Callers pop fields (password, temp_id) before returning to users
+        return dict(doc)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def update(self, doc: Dict) -> Dict:
+        if "temp_id" not in doc:
+            doc = normalize_auth_doc(doc)
+        with self._lock:
+            self._remove_locked(doc["_id"])
+            self._accounts[doc["_id"]] = doc
+            for key in self._account_keys(doc):
+                self._keys[key] = doc["_id"]
+            updated_at = doc.get("updated_at")
+            if updated_at and (self._last_seen_update is None or updated_at > self._last_seen_update):
+                self._last_seen_update = updated_at
+            AUTH_KEY_INDEX_SIZE.set(len(self._keys))
+        return doc
+
+    def patch(self, account_id, fields: Dict) -> None:
+        # Apply a known change to the cached account without re-reading it
+        account_id = str(account_id) if isinstance(account_id, ObjectId) else account_id
+        with self._lock:
+            doc = self._accounts.get(account_id)
+            if doc is not None:
+                self._accounts[account_id] = {**doc, **fields}
+
+    def refresh(self, account_id) -> Optional[Dict]:
+        doc = self.collection.find_one({"_id": account_id}, INDEX_PROJECTION)
+        if doc is None:
+            self.remove(account_id)
+            return None
+        return self.update(doc)
+
+    async def arefresh(self, account_id) -> Optional[Dict]:
+        doc = await self.async_collection.find_one({"_id": account_id}, INDEX_PROJECTION)
+        if doc is None:
+            self.remove(account_id)
+            return None
+        return self.update(doc)
+
+    def remove(self, account_id) -> None:
+        account_id = str(account_id) if isinstance(account_id, ObjectId) else account_id
+        with self._lock:
+            self._remove_locked(account_id)
+            AUTH_KEY_INDEX_SIZE.set(len(self._keys))
+
+    def _remove_locked(self, account_id: str) -> None:
+        old = self._accounts.pop(account_id, None)
+        if old is None:
+            return
+        for key in self._account_keys(old):
+            if self._keys.get(key) == account_id:
+                del self._keys[key]
+
+    @staticmethod
+    def _account_keys(doc: Dict):
+        yield doc["_id"]
+        for api_key in doc.get("api_keys", []):
+            yield api_key["key"]
+
+    @staticmethod
+    def _key_filters(key: str):
+        filters = [{"_id": key}, {"api_keys.key": key}]
+        if ObjectId.is_valid(key):
+            filters.append({"_id": ObjectId(key)})
+        return filters
+
+    def _watch(self) -> None:
+        while True:
+            try:
+                with self.collection.watch(full_document="updateLookup") as stream:
+                    print("Watching auth_keys change stream", flush=True)
+                    # Catch anything written between the initial load and the stream opening
+                    self.load()
+                    while stream.alive:
+                        change = stream.try_next()
+                        self._last_sync = time.time()
+                        if change is not None:
+                            self._apply_change(change)
+            except OperationFailure as e:
+                # Standalone servers don't support change streams
+                print(f"Auth key change stream unavailable, polling instead: {e}", flush=True)
+                self._poll()
+                return
+            except PyMongoError as e:
+                print(f"Auth key change stream interrupted: {e}", flush=True)
+                time.sleep(AUTH_KEY_INDEX_POLL_INTERVAL)
+
+    def _apply_change(self, change: Dict) -> None:
+        operation = change["operationType"]
+        if operation in ("insert", "update", "replace"):
+            doc = change.get("fullDocument")
+            if doc is not None:
+                self.update(doc)
+            else:
+                self.remove(change["documentKey"]["_id"])
+        elif operation == "delete":
+            self.remove(change["documentKey"]["_id"])
+        elif operation in ("drop", "rename", "dropDatabase", "invalidate"):
+            self.load()
+
+    def _poll(self) -> None:
+        last_full_reload = time.time()
+        while True:
+            time.sleep(AUTH_KEY_INDEX_POLL_INTERVAL)
+            try:
+                if time.time() - last_full_reload > AUTH_KEY_INDEX_FULL_RELOAD_INTERVAL:
+                    # Deletions and documents without updated_at only show up on a full reload
+                    self.load()
+                    last_full_reload = time.time()
+                    continue
+                query = {"updated_at": {"$gt": self._last_seen_update or datetime.min}}
+                for doc in self.collection.find(query, INDEX_PROJECTION):
+                    self.update(doc)
+                self._last_sync = time.time()
+            except PyMongoError as e:
+                print(f"Failed to poll auth keys: {e}", flush=True)
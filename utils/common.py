@@ -2,6 +2,7 @@ import bcrypt
 from PIL import Image
 import io
 import base64
+from datetime import datetime
 
 def hash_password(password):
     # Generate a salt
@@ -22,3 +23,23 @@ def pil_image_to_base64(image: Image.Image, format="JPEG") -> str:
     image.save(image_stream, format=format)
     base64_image = base64.b64encode(image_stream.getvalue()).decode("utf-8")
     return base64_image
+
+def usage_bucket_start(timestamp: datetime) -> datetime:
+    # Usage events are stored in one document per account per hour
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+def usage_bucket_id(account_id, timestamp: datetime) -> str:
+    return f"{account_id}:{usage_bucket_start(timestamp).strftime('%Y-%m-%dT%H')}"
+
+def usage_aggregate_fields(timestamp: datetime, model_name: str, cost: float) -> dict:
+    # Rolling per-day, per-model aggregates kept on the auth key document
+    day = timestamp.strftime("%Y-%m-%d")
+    model = (model_name or "unknown").replace(".", "_").replace("$", "_")
+    return {
+        f"usage_daily.{day}.{model}.count": 1,
+        f"usage_daily.{day}.{model}.spend": cost,
+    }
+
+def normalize_prompt(prompt: str) -> str:
+    # Cache key for per-prompt lookups (moderation, expansion, classification)
+    return " ".join(prompt.lower().split())
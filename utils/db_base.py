@@ -1,9 +1,36 @@
+import os
+from motor.motor_asyncio import AsyncIOMotorClient
 from pymongo import MongoClient
 from typing import Dict
 
+from utils.db_metrics import listeners
+
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 50))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 5))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", 60000))
+# Sync handlers and the remaining blocking driver calls run on a thread pool of this size
+MONGO_SYNC_THREADS = int(os.getenv("MONGO_SYNC_THREADS", 16))
+
+def pool_options(client: str) -> Dict:
+  return {
+    "maxPoolSize": MONGO_MAX_POOL_SIZE,
+    "minPoolSize": MONGO_MIN_POOL_SIZE,
+    "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+    "event_listeners": listeners(client),
+  }
+
 class DBBase:
   def __init__(self, mongoDBConnectUri: str) -> None:
-    self.client = MongoClient(mongoDBConnectUri)
+    # Background threads and sync handlers use the blocking client
+    self.client = MongoClient(mongoDBConnectUri, **pool_options("sync"))
+    # Anything running on the event loop uses the async client
+    self.async_client = AsyncIOMotorClient(mongoDBConnectUri, **pool_options("async"))
+
+  def close(self) -> None:
+    self.async_client.close()
+    self.client.close()
 
   def get_collection(self, collection_name: str):
     return self.db[collection_name]
@@ -19,7 +46,7 @@ class DBBase:
   def find(self, collection_name: str, query: Dict):
     collection = self.get_collection(collection_name)
     return collection.find(query)
-  
+
   def delete_one(self, collection_name: str, query: Dict):
     collection = self.get_collection(collection_name)
     return collection.delete_one(query)
\ No newline at end of file
@@ -2,12 +2,12 @@ import os
 from constants import DB_NAME, CollectionName
 from bson.json_util import dumps
 from typing import Dict
-from threading import Thread
-import time
-from bson import ObjectId
 
+from utils.auth_key_index import AuthKeyIndex, normalize_auth_doc
+from utils.model_config import ModelConfigStore
 from utils.db_base import DBBase
 from utils.db_schemas import AuthKeySchema, ValidatorSchema
+from utils.write_behind import WriteBehindQueue
 from utils.feed_data import AUTH_KEYS_FEED, MODEL_CONFIG_FEED, VALIDATORS_FEED
 from dotenv import load_dotenv
 
@@ -22,28 +22,60 @@ MONGOPORT = os.getenv("MONGOPORT", 27017)
 mongoDBConnectUri = f"mongodb://{MONGOUSER}:{MONGOPASSWORD}@{MONGOHOST}:{MONGOPORT}"
 print(mongoDBConnectUri)
 
+class AsyncCollections:
+  # Same accessors as MongoDBHandler, backed by the async driver
+  def __init__(self, db) -> None:
+    self.db = db
+    self.validators_collection = db[CollectionName.VALIDATORS.value]
+    self.auth_keys_collection = db[CollectionName.AUTH_KEYS.value]
+    self.model_config = db[CollectionName.MODEL_CONFIG.value]
+    self.private_key = db[CollectionName.PRIVATE_KEY.value]
+    self.logs_collection = db[CollectionName.LOGS.value]
+    self.usage_collection = db[CollectionName.USAGE.value]
+    self.leases_collection = db[CollectionName.LEASES.value]
+    self.metagraph_collection = db[CollectionName.METAGRAPH.value]
+
+
 class MongoDBHandler(DBBase):
   def __init__(self, dbname = DB_NAME) -> None:
+    # No I/O here: MongoClient connects lazily, everything that talks to the
+    # server happens in initialize(), which the app runs after it starts serving
     super().__init__(mongoDBConnectUri)
-    is_first_time = False
-    
-    # Check if the database exists
-    if dbname not in self.client.list_database_names():
-      is_first_time = True
-      print("Creating database", flush=True)
-      self.client[dbname].create_collection(CollectionName.VALIDATORS.value)
-      self.client[dbname].create_collection(CollectionName.AUTH_KEYS.value)
-      self.client[dbname].create_collection(CollectionName.PRIVATE_KEY.value)
-      self.client[dbname].create_collection(CollectionName.MODEL_CONFIG.value)
-      self.client[dbname].create_collection(CollectionName.LOGS.value)
-      
-
+    self.dbname = dbname
     self.db = self.client[dbname]
     self.validators_collection = self.db[CollectionName.VALIDATORS.value]
     self.auth_keys_collection = self.db[CollectionName.AUTH_KEYS.value]
     self.model_config = self.db[CollectionName.MODEL_CONFIG.value]
     self.private_key = self.db[CollectionName.PRIVATE_KEY.value]
     self.logs_collection = self.db[CollectionName.LOGS.value]
+    self.usage_collection = self.db[CollectionName.USAGE.value]
+    self.leases_collection = self.db[CollectionName.LEASES.value]
+    self.metagraph_collection = self.db[CollectionName.METAGRAPH.value]
+    # For code on the event loop: await dbhandler.aio.auth_keys_collection.find_one(...)
+    self.aio = AsyncCollections(self.async_client[dbname])
+
+    self.auth_key_index = AuthKeyIndex(self.auth_keys_collection, self.aio.auth_keys_collection)
+    # Started/drained by the app lifespan, writes go straight to MongoDB until then
+    self.writer = WriteBehindQueue(self.db)
+    self.model_config_store = ModelConfigStore(self.model_config)
+
+  def initialize(self) -> None:
+    # verify db connection
+    print(self.client.server_info(), flush=True)
+    is_first_time = False
+    
+    # Check if the database exists
+    if self.dbname not in self.client.list_database_names():
+      is_first_time = True
+      print("Creating database", flush=True)
+      self.db.create_collection(CollectionName.VALIDATORS.value)
+      self.db.create_collection(CollectionName.AUTH_KEYS.value)
+      self.db.create_collection(CollectionName.PRIVATE_KEY.value)
+      self.db.create_collection(CollectionName.MODEL_CONFIG.value)
+      self.db.create_collection(CollectionName.LOGS.value)
+      self.db.create_collection(CollectionName.USAGE.value)
+      self.db.create_collection(CollectionName.LEASES.value)
+      self.db.create_collection(CollectionName.METAGRAPH.value)
     
     # Feed data to the collections
     if is_first_time:
@@ -51,30 +83,34 @@ class MongoDBHandler(DBBase):
       self.auth_keys_collection.insert_many(AUTH_KEYS_FEED)
       self.model_config.insert_many(MODEL_CONFIG_FEED)
       is_first_time = False
-    
-    Thread(target=self.update_model_config, daemon=True).start()
-    
-  def update_model_config(self):
-      while True:
-        time.sleep(60)
-        # Fetch new data from MongoDB and update self.model_config
-        self.model_config = self.db[CollectionName.MODEL_CONFIG.value]
-            
+
+    self.ensure_indexes()
+    self.auth_key_index.start()
+    self.model_config_store.start()
+
+  def ensure_indexes(self):
+    # create_index is a no-op when the index already exists
+    self.auth_keys_collection.create_index("api_keys.key")
+    self.auth_keys_collection.create_index("email")
+    self.auth_keys_collection.create_index("updated_at")
+    self.usage_collection.create_index([("account_id", 1), ("start", 1)])
+    self.logs_collection.create_index([("api_key", 1), ("timestamp", 1), ("_id", 1)])
+    self.logs_collection.create_index([("api_key", 1), ("action", 1), ("timestamp", 1)])
+
   def get_available_validators(self) -> Dict[str, ValidatorSchema]:
     return {doc["_id"]: doc for doc in self.validators_collection.find()}
 
+  async def aget_available_validators(self) -> Dict[str, ValidatorSchema]:
+    # The per-day counters only ever grow, nothing on the request path reads them
+    return {doc["_id"]: doc async for doc in self.aio.validators_collection.find({}, {"counter": 0})}
+
   def get_auth_keys(self) -> Dict[str, AuthKeySchema]:
     auth_keys = {}
     for doc in self.auth_keys_collection.find():
-        key = str(doc["_id"]) if isinstance(doc["_id"], ObjectId) else doc["_id"]
-        doc["temp_id"] = doc["_id"]
-        doc["_id"] = key  # Update the _id in the document itself
-        auth_keys[key] = doc
+        doc = normalize_auth_doc(doc)
+        auth_keys[doc["_id"]] = doc
         if "api_keys" in doc:
           for docKey in doc["api_keys"]:
             auth_keys[docKey["key"]] = doc
-      
-    for k, v in auth_keys.items():
-      v.setdefault("credit", 5)
     return auth_keys
 
@@ -0,0 +1,95 @@
+import threading
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from pymongo import monitoring
+
+MONGO_OPERATION_SECONDS = Histogram(
+    "mongo_operation_seconds",
+    "MongoDB command latency as seen by the driver",
+    ["client", "command", "outcome"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+MONGO_POOL_WAIT_SECONDS = Histogram(
+    "mongo_pool_wait_seconds",
+    "Time spent waiting to check a connection out of the MongoDB driver pool",
+    ["client"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+)
+MONGO_POOL_CHECKED_OUT = Gauge(
+    "mongo_pool_checked_out_connections", "MongoDB connections currently checked out", ["client"]
+)
+MONGO_POOL_CHECKOUT_FAILURES = Counter(
+    "mongo_pool_checkout_failures_total", "Failed MongoDB connection checkouts", ["client", "reason"]
+)
+
+
+class CommandMetrics(monitoring.CommandListener):
+    def __init__(self, client: str):
+        self.client = client
+
+    def started(self, event) -> None:
+        pass
+
+    def succeeded(self, event) -> None:
+        MONGO_OPERATION_SECONDS.labels(
+            client=self.client, command=event.command_name, outcome="success"
+        ).observe(event.duration_micros / 1e6)
+
+    def failed(self, event) -> None:
+        MONGO_OPERATION_SECONDS.labels(
+            client=self.client, command=event.command_name, outcome="failure"
+        ).observe(event.duration_micros / 1e6)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    def __init__(self, client: str):
+        self.client = client
+        # Checkout start time, for drivers whose events don't carry a duration;
+        # a checkout starts and finishes on the same thread
+        self._local = threading.local()
+
+    def _wait(self, event) -> float:
+        duration = getattr(event, "duration", None)
+        if duration is not None:
+            return duration
+        return time.perf_counter() - getattr(self._local, "started", time.perf_counter())
+
+    def connection_check_out_started(self, event) -> None:
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event) -> None:
+        MONGO_POOL_WAIT_SECONDS.labels(client=self.client).observe(self._wait(event))
+        MONGO_POOL_CHECKED_OUT.labels(client=self.client).inc()
+
+    def connection_check_out_failed(self, event) -> None:
+        MONGO_POOL_WAIT_SECONDS.labels(client=self.client).observe(self._wait(event))
+        MONGO_POOL_CHECKOUT_FAILURES.labels(client=self.client, reason=str(event.reason)).inc()
+
+    def connection_checked_in(self, event) -> None:
+        MONGO_POOL_CHECKED_OUT.labels(client=self.client).dec()
+
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_ready(self, event) -> None:
+        pass
+
+    def pool_cleared(self, event) -> None:
+        pass
+
+    def pool_closed(self, event) -> None:
+        pass
+
+    def connection_created(self, event) -> None:
+        pass
+
+    def connection_ready(self, event) -> None:
+        pass
+
+    def connection_closed(self, event) -> None:
+        pass
+
+
+def listeners(client: str):
+    return [CommandMetrics(client), PoolMetrics(client)]
@@ -0,0 +1,76 @@
+import asyncio
+import json
+import os
+import time
+from typing import Awaitable, Optional, TypeVar
+
+from fastapi import HTTPException, Request
+from prometheus_client import Counter
+
+# Seconds the client is willing to wait, capped at REQUEST_MAX_TIMEOUT
+REQUEST_TIMEOUT_HEADER = "X-Request-Timeout"
+REQUEST_DEFAULT_TIMEOUT = float(os.getenv("REQUEST_DEFAULT_TIMEOUT", 120))
+REQUEST_MAX_TIMEOUT = float(os.getenv("REQUEST_MAX_TIMEOUT", 300))
+# JSON object of pipeline type -> default timeout, merged over the defaults below
+REQUEST_TIMEOUTS = {
+    "text_generation": 60.0,
+    "gojourney": 180.0,
+    **json.loads(os.getenv("REQUEST_TIMEOUTS", "{}")),
+}
+DISCONNECT_POLL_INTERVAL = 1.0
+
+REQUESTS_ABANDONED = Counter(
+    "requests_abandoned_total", "Requests given up on before a validator answered", ["reason"]
+)
+
+T = TypeVar("T")
+
+
+class Deadline:
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+
+    @classmethod
+    def for_request(cls, request: Optional[Request], pipeline_type: str) -> "Deadline":
+        timeout = REQUEST_TIMEOUTS.get(pipeline_type, REQUEST_DEFAULT_TIMEOUT)
+        header = request.headers.get(REQUEST_TIMEOUT_HEADER) if request is not None else None
+        if header:
+            try:
+                timeout = float(header)
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Invalid {REQUEST_TIMEOUT_HEADER} header")
+            if timeout <= 0:
+                raise HTTPException(status_code=400, detail=f"Invalid {REQUEST_TIMEOUT_HEADER} header")
+        return cls(min(timeout, REQUEST_MAX_TIMEOUT))
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def epoch(self) -> float:
+        # Wall clock form for other hosts, monotonic time doesn't mean anything there
+        return time.time() + self.remaining()
+
+
+async def cancel_on_disconnect(request: Optional[Request], awaitable: Awaitable[T]) -> T:
+    # Only call once the request body has been read: polling consumes receive() messages
+    task = asyncio.ensure_future(awaitable)
+    if request is None:
+        return await task
+    try:
+        while True:
+            done, _ = await asyncio.wait((task,), timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                print("Client disconnected, cancelling request", flush=True)
+                REQUESTS_ABANDONED.labels(reason="disconnect").inc()
+                raise HTTPException(status_code=499, detail="Client closed request")
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
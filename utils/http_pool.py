@@ -0,0 +1,140 @@
+import os
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+from prometheus_client import Counter, Gauge
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 2))
+VALIDATOR_READ_TIMEOUT = float(os.getenv("VALIDATOR_READ_TIMEOUT", 64))
+EXTERNAL_READ_TIMEOUT = float(os.getenv("EXTERNAL_READ_TIMEOUT", 4))
+VALIDATOR_MAX_CONNECTIONS = int(os.getenv("VALIDATOR_MAX_CONNECTIONS", 32))
+EXTERNAL_MAX_CONNECTIONS = int(os.getenv("EXTERNAL_MAX_CONNECTIONS", 64))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() == "true"
+
+HTTP_POOL_IN_FLIGHT = Gauge(
+    "http_pool_in_flight_requests", "Requests currently using a pooled HTTP client", ["pool"]
+)
+HTTP_POOL_MAX_CONNECTIONS = Gauge(
+    "http_pool_max_connections", "Connection limit of a pooled HTTP client", ["pool"]
+)
+HTTP_POOL_REQUESTS = Counter(
+    "http_pool_requests_total",
+    "Requests sent through a pooled HTTP client, by whether a new connection was opened",
+    ["pool", "connection"],
+)
+
+EXTERNAL_POOL = "external"
+
+
+class ResponseTooLarge(Exception):
+    pass
+
+
+def _http2_available() -> bool:
+    if not HTTP2_ENABLED:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        print("HTTP2_ENABLED is set but the h2 package is missing, using HTTP/1.1", flush=True)
+        return False
+    return True
+
+
+class HTTPClientPool:
+    def __init__(self):
+        self.http2 = _http2_available()
+        self._validator_clients: Dict[str, httpx.AsyncClient] = {}
+        self._external_client: Optional[httpx.AsyncClient] = None
+
+    def _new_client(self, pool: str, max_connections: int, read_timeout: float) -> httpx.AsyncClient:
+        HTTP_POOL_MAX_CONNECTIONS.labels(pool=pool).set(max_connections)
+        return httpx.AsyncClient(
+            http2=self.http2,
+            timeout=httpx.Timeout(read_timeout, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+
+    async def start(self) -> None:
+        if self._external_client is None:
+            self._external_client = self._new_client(
+                EXTERNAL_POOL, EXTERNAL_MAX_CONNECTIONS, EXTERNAL_READ_TIMEOUT
+            )
+
+    async def close(self) -> None:
+        clients = list(self._validator_clients.values())
+        if self._external_client is not None:
+            clients.append(self._external_client)
+        self._validator_clients = {}
+        self._external_client = None
+        for client in clients:
+            await client.aclose()
+
+    @property
+    def external(self) -> httpx.AsyncClient:
+        if self._external_client is None:
+            raise RuntimeError("HTTP client pool used before start()")
+        return self._external_client
+
+    def validator_client(self, endpoint: str) -> httpx.AsyncClient:
+        # One client per validator origin so a slow validator can't exhaust everyone's connections
+        origin = "{0.scheme}://{0.netloc}".format(urlsplit(endpoint))
+        client = self._validator_clients.get(origin)
+        if client is None:
+            client = self._new_client(origin, VALIDATOR_MAX_CONNECTIONS, VALIDATOR_READ_TIMEOUT)
+            self._validator_clients[origin] = client
+        return client
+
+    async def post_validator(self, endpoint: str, **kwargs) -> httpx.Response:
+        origin = "{0.scheme}://{0.netloc}".format(urlsplit(endpoint))
+        return await self._send(origin, self.validator_client(endpoint), endpoint, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self._send(EXTERNAL_POOL, self.external, url, **kwargs)
+
+    async def fetch(self, url: str, max_bytes: int, **kwargs) -> bytes:
+        # Streamed GET on the external pool that stops reading once the body passes max_bytes
+        in_flight = HTTP_POOL_IN_FLIGHT.labels(pool=EXTERNAL_POOL)
+        in_flight.inc()
+        try:
+            async with self.external.stream("GET", url, **kwargs) as response:
+                response.raise_for_status()
+                length = response.headers.get("content-length")
+                if length and length.isdigit() and int(length) > max_bytes:
+                    raise ResponseTooLarge(f"{url} is {length} bytes, the limit is {max_bytes}")
+                chunks = []
+                size = 0
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise ResponseTooLarge(f"{url} is over the {max_bytes} byte limit")
+                    chunks.append(chunk)
+                return b"".join(chunks)
+        finally:
+            in_flight.dec()
+
+    async def _send(self, pool: str, client: httpx.AsyncClient, url: str, **kwargs) -> httpx.Response:
+        new_connection = False
+
+        async def trace(event_name, info):
+            nonlocal new_connection
+            if event_name == "connection.connect_tcp.started":
+                new_connection = True
+
+        extensions = dict(kwargs.pop("extensions", None) or {})
+        extensions["trace"] = trace
+        in_flight = HTTP_POOL_IN_FLIGHT.labels(pool=pool)
+        in_flight.inc()
+        try:
+            return await client.post(url, extensions=extensions, **kwargs)
+        finally:
+            in_flight.dec()
+            HTTP_POOL_REQUESTS.labels(
+                pool=pool, connection="new" if new_connection else "reused"
+            ).inc()
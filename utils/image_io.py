@@ -0,0 +1,111 @@
+import json
+from typing import Optional, Tuple, Type
+
+from fastapi import HTTPException, Request, UploadFile
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
+
+from utils.image_processing import MAX_IMAGE_BYTES
+
+IMAGE_MEDIA_TYPES = {
+    "image/jpeg": "JPEG",
+    "image/png": "PNG",
+    "image/webp": "WEBP",
+}
+# Form fields and query parameters arrive as strings, these hold JSON objects
+JSON_FIELDS = ("advanced_params",)
+
+
+def negotiate_image_format(request: Request) -> Optional[Tuple[str, Optional[str]]]:
+    # (media type, PIL format) when the client asked for raw image bytes, None keeps the JSON contract.
+    # image/* yields ("image/*", None): serve whatever format the image already is.
+    best = None
+    for part in request.headers.get("accept", "").split(","):
+        media_type, _, params = part.strip().partition(";")
+        media_type = media_type.strip().lower()
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality <= 0:
+            continue
+        if (media_type in IMAGE_MEDIA_TYPES or media_type == "image/*") and (best is None or quality > best[0]):
+            best = (quality, media_type)
+    if best is None:
+        return None
+    return best[1], IMAGE_MEDIA_TYPES.get(best[1])
+
+
+def media_type_for(format: str) -> str:
+    return next(media_type for media_type, value in IMAGE_MEDIA_TYPES.items() if value == format)
+
+
+async def read_image_request(
+    request: Request, model: Type[BaseModel], image_field: Optional[str] = "conditional_image"
+) -> Tuple[BaseModel, Optional[bytes]]:
+    # Accepts the JSON/base64 body existing clients send, multipart/form-data with the
+    # image as a file part, or the raw image as the body with the other fields in the query string
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    image = None
+    if content_type == "multipart/form-data":
+        form = await request.form()
+        fields = {}
+        for name, value in form.multi_items():
+            if isinstance(value, UploadFile):
+                if name == image_field:
+                    image = await read_upload(value)
+            else:
+                fields[name] = value
+    elif image_field and (content_type.startswith("image/") or content_type == "application/octet-stream"):
+        fields = dict(request.query_params)
+        image = await read_body(request)
+    else:
+        try:
+            fields = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+    if not isinstance(fields, dict):
+        raise HTTPException(status_code=400, detail="Expected a JSON object")
+    for name in JSON_FIELDS:
+        if isinstance(fields.get(name), str):
+            try:
+                fields[name] = json.loads(fields[name])
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"{name} must be a JSON object")
+    if image is not None:
+        # The model still requires the field, the handler uses the bytes instead
+        fields[image_field] = ""
+    try:
+        data = model(**fields)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    if image_field and image is None and not getattr(data, image_field):
+        raise HTTPException(status_code=400, detail=f"Missing {image_field}")
+    return data, image
+
+
+async def read_upload(upload: UploadFile) -> bytes:
+    data = await upload.read(MAX_IMAGE_BYTES + 1)
+    if len(data) > MAX_IMAGE_BYTES:
+        raise HTTPException(
+            status_code=413, detail=f"Image too large, the limit is {MAX_IMAGE_BYTES} bytes"
+        )
+    return data
+
+
+async def read_body(request: Request) -> bytes:
+    # Stop reading as soon as the limit is crossed instead of buffering the whole upload
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_IMAGE_BYTES:
+            raise HTTPException(
+                status_code=413, detail=f"Image too large, the limit is {MAX_IMAGE_BYTES} bytes"
+            )
+        chunks.append(chunk)
+    return b"".join(chunks)
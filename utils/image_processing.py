@@ -0,0 +1,213 @@
+import asyncio
+import base64
+import io
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple, Union
+
+from fastapi import HTTPException
+from PIL import Image
+from prometheus_client import Counter, Gauge, Histogram
+
+# process | thread
+IMAGE_EXECUTOR = os.getenv("IMAGE_EXECUTOR", "process")
+IMAGE_EXECUTOR_WORKERS = int(os.getenv("IMAGE_EXECUTOR_WORKERS", os.cpu_count() or 2))
+IMAGE_MAX_CONCURRENCY = int(os.getenv("IMAGE_MAX_CONCURRENCY", IMAGE_EXECUTOR_WORKERS * 2))
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", 20 * 1024 * 1024))
+# Format and quality images are re-encoded with before they're sent to validators
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 75))
+IMAGE_RESAMPLE = os.getenv("IMAGE_RESAMPLE", "BICUBIC").upper()
+# Inputs in these formats that need no resizing are forwarded without being decoded
+IMAGE_PASSTHROUGH_FORMATS = set(
+    os.getenv("IMAGE_PASSTHROUGH_FORMATS", IMAGE_OUTPUT_FORMAT).upper().split(",")
+)
+# Formats image/* responses can be served in
+SERVED_FORMATS = ("JPEG", "PNG", "WEBP")
+# Scale images smaller than max_size up to it, false passes small conforming images through
+IMAGE_UPSCALE_SMALL = os.getenv("IMAGE_UPSCALE_SMALL", "true").lower() == "true"
+
+IMAGE_QUEUE_DEPTH = Gauge(
+    "image_preprocess_queue_depth", "Image preprocessing jobs waiting for an executor slot"
+)
+IMAGE_IN_FLIGHT = Gauge(
+    "image_preprocess_in_flight", "Image preprocessing jobs currently running"
+)
+IMAGE_STAGE_SECONDS = Histogram(
+    "image_preprocess_stage_seconds",
+    "Time spent in each image preprocessing stage",
+    ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+IMAGE_PREPROCESS_PATHS = Counter(
+    "image_preprocess_total",
+    "Preprocessed images by path taken: passthrough, draft or full decode",
+    ["path"],
+)
+
+
+def check_image_size(image: Union[str, bytes]) -> None:
+    if isinstance(image, bytes):
+        size = len(image)
+    else:
+        # Reject before decoding anything: base64 is 4 chars per 3 bytes
+        size = len(image) * 3 // 4 - image[-2:].count("=")
+    if size > MAX_IMAGE_BYTES:
+        raise HTTPException(
+            status_code=413, detail=f"Image too large, the limit is {MAX_IMAGE_BYTES} bytes"
+        )
+
+
+def base64_to_pil_image(base64_image):
+    image = base64.b64decode(base64_image)
+    image = io.BytesIO(image)
+    image = Image.open(image)
+    return image
+
+
+def pil_image_to_base64(image: Image.Image, format="JPEG") -> str:
+    if format not in ["JPEG", "PNG"]:
+        format = "JPEG"
+    image_stream = io.BytesIO()
+    image.save(image_stream, format=format)
+    base64_image = base64.b64encode(image_stream.getvalue()).decode("utf-8")
+    return base64_image
+
+
+def target_size(size: Tuple[int, int], max_size=1024, divisible=16) -> Tuple[int, int]:
+    W, H = size
+    if not IMAGE_UPSCALE_SMALL and max(W, H) <= max_size:
+        return W - W % divisible, H - H % divisible
+    if W > H:
+        W, H = max_size, int(max_size * H / W)
+    else:
+        W, H = int(max_size * W / H), max_size
+    W = W - W % divisible
+    H = H - H % divisible
+    return W, H
+
+
+def resize_divisible(image, max_size=1024, divisible=16):
+    return image.resize(target_size(image.size, max_size, divisible), resample=Image.Resampling[IMAGE_RESAMPLE])
+
+
+def encode(image: Image.Image, format: str = IMAGE_OUTPUT_FORMAT) -> bytes:
+    if format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    image_stream = io.BytesIO()
+    if format in ("JPEG", "WEBP"):
+        image.save(image_stream, format=format, quality=IMAGE_QUALITY)
+    else:
+        image.save(image_stream, format=format)
+    return image_stream.getvalue()
+
+
+def preprocess_image(
+    image: Union[str, bytes], resize: bool = True, max_size: int = 1024, divisible: int = 16
+) -> Tuple[str, str, Dict[str, float]]:
+    # Runs in the executor, keep it a module-level function so it can be pickled.
+    # Accepts an uploaded image as raw bytes or the base64 string from a JSON body.
+    # Returns (base64 image, path taken, seconds per stage); metrics are recorded by
+    # the caller since a worker process has its own registry.
+    timings = {}
+    start = time.perf_counter()
+    data = image if isinstance(image, bytes) else base64.b64decode(image)
+    # Image.open only parses the header, pixels are decoded on load()
+    pil_image = Image.open(io.BytesIO(data))
+    size = target_size(pil_image.size, max_size, divisible) if resize else pil_image.size
+    timings["probe"] = time.perf_counter() - start
+
+    if size == pil_image.size and pil_image.format in IMAGE_PASSTHROUGH_FORMATS:
+        return base64.b64encode(data).decode("utf-8"), "passthrough", timings
+
+    path = "full"
+    start = time.perf_counter()
+    if pil_image.format == "JPEG" and size[0] < pil_image.size[0]:
+        # Let libjpeg decode at 1/2, 1/4 or 1/8 scale, never below the target size
+        pil_image.draft(pil_image.mode, size)
+        path = "draft"
+    pil_image.load()
+    timings["decode"] = time.perf_counter() - start
+
+    if pil_image.size != size:
+        start = time.perf_counter()
+        pil_image = pil_image.resize(size, resample=Image.Resampling[IMAGE_RESAMPLE])
+        timings["resize"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    encoded = base64.b64encode(encode(pil_image)).decode("utf-8")
+    timings["encode"] = time.perf_counter() - start
+    return encoded, path, timings
+
+
+def convert_image(data: bytes, format: Optional[str]) -> Tuple[bytes, str]:
+    # Returns (bytes, format). Bytes already in the wanted format (or any format when
+    # format is None and the source is one we serve) are returned untouched.
+    image = Image.open(io.BytesIO(data))
+    if format is None:
+        if image.format in SERVED_FORMATS:
+            return data, image.format
+        format = IMAGE_OUTPUT_FORMAT
+    if image.format == format:
+        return data, format
+    return encode(image, format), format
+
+
+def encode_image(base64_image: str, format: Optional[str]) -> Tuple[bytes, str]:
+    # Raw bytes for an image/* response
+    return convert_image(base64.b64decode(base64_image), format)
+
+
+def image_to_base64(data: bytes, format: str = "JPEG") -> str:
+    return base64.b64encode(convert_image(data, format)[0]).decode("utf-8")
+
+
+class ImageExecutor:
+    def __init__(self, kind: str = IMAGE_EXECUTOR, workers: int = IMAGE_EXECUTOR_WORKERS):
+        self.kind = kind
+        self.workers = workers
+        self._executor: Optional[Executor] = None
+        self._semaphore = asyncio.Semaphore(IMAGE_MAX_CONCURRENCY)
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                # spawn: forking a process that already runs Mongo/metagraph threads isn't safe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="image"
+                )
+        return self._executor
+
+    async def run(self, fn, *args):
+        IMAGE_QUEUE_DEPTH.inc()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            IMAGE_QUEUE_DEPTH.dec()
+        IMAGE_IN_FLIGHT.inc()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            IMAGE_IN_FLIGHT.dec()
+            self._semaphore.release()
+
+    async def preprocess(self, image: Union[str, bytes], resize: bool = True, max_size: int = 1024, divisible: int = 16) -> str:
+        start = time.perf_counter()
+        encoded, path, timings = await self.run(preprocess_image, image, resize, max_size, divisible)
+        IMAGE_STAGE_SECONDS.labels(stage="total").observe(time.perf_counter() - start)
+        for stage, seconds in timings.items():
+            IMAGE_STAGE_SECONDS.labels(stage=stage).observe(seconds)
+        IMAGE_PREPROCESS_PATHS.labels(path=path).inc()
+        return encoded
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,83 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from prometheus_client import Gauge
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", 30))
+
+LEADER_LEASE_HELD = Gauge(
+    "leader_lease_held", "Whether this process currently holds the lease (1) or not (0)", ["lease"]
+)
+
+
+class LeaderLease:
+    # One document per lease: {_id: name, holder, expires_at}. Whoever holds an
+    # unexpired lease is the leader, everyone else keeps trying to take it over
+    # once it expires. Renewed every ttl / 3 seconds.
+    def __init__(self, collection, name: str, ttl: float = LEADER_LEASE_TTL):
+        self.collection = collection
+        self.name = name
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # Local deadline, so a leader that can't reach MongoDB stops acting before its lease can be taken over
+        self._valid_until = 0.0
+        self._stopped = threading.Event()
+        LEADER_LEASE_HELD.labels(lease=name).set(0)
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._valid_until
+
+    def start(self) -> None:
+        self.try_acquire()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def try_acquire(self) -> bool:
+        was_leader = self.is_leader
+        started = time.monotonic()
+        now = datetime.utcnow()
+        try:
+            doc = self.collection.find_one_and_update(
+                {"_id": self.name, "$or": [{"holder": self.holder}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"holder": self.holder, "expires_at": now + timedelta(seconds=self.ttl), "renewed_at": now}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Held by someone else: the filter didn't match and the upsert collided on _id
+            doc = None
+        except PyMongoError as e:
+            # Keep whatever we had until the local deadline runs out
+            print(f"Failed to renew lease {self.name}: {e}", flush=True)
+            return self.is_leader
+        if doc is not None and doc.get("holder") == self.holder:
+            # Measured from before the round trip, with a margin for clock drift between hosts
+            self._valid_until = started + self.ttl * 0.8
+        else:
+            self._valid_until = 0.0
+        if self.is_leader != was_leader:
+            print(f"{'Acquired' if self.is_leader else 'Lost'} lease {self.name} as {self.holder}", flush=True)
+            LEADER_LEASE_HELD.labels(lease=self.name).set(1 if self.is_leader else 0)
+        return self.is_leader
+
+    def release(self) -> None:
+        self._stopped.set()
+        if not self.is_leader:
+            return
+        self._valid_until = 0.0
+        LEADER_LEASE_HELD.labels(lease=self.name).set(0)
+        try:
+            # Let another process take over right away instead of waiting out the TTL
+            self.collection.delete_one({"_id": self.name, "holder": self.holder})
+        except PyMongoError as e:
+            print(f"Failed to release lease {self.name}: {e}", flush=True)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.ttl / 3):
+            self.try_acquire()
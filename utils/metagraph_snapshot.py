@@ -0,0 +1,84 @@
+import json
+import os
+import time
+from dataclasses import dataclass, field, replace
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class MetagraphSnapshot:
+    # Built off-thread after each sync and published with a single attribute swap,
+    # so a request never sees hotkeys and stakes from two different syncs.
+    block: int = 0
+    hotkeys: Tuple[str, ...] = ()
+    stakes: Tuple[float, ...] = ()
+    # hotkey -> uid
+    uids: Mapping[str, int] = field(default_factory=dict)
+    # (hotkey, stake) of registered validators currently marked active
+    active_validators: Tuple[Tuple[str, float], ...] = ()
+    synced_at: float = 0.0
+
+    @classmethod
+    def from_metagraph(cls, metagraph) -> "MetagraphSnapshot":
+        hotkeys = tuple(metagraph.hotkeys)
+        stakes = tuple(float(stake) for stake in metagraph.total_stake)
+        return cls(
+            block=int(metagraph.block),
+            hotkeys=hotkeys,
+            stakes=stakes,
+            uids=MappingProxyType({hotkey: uid for uid, hotkey in enumerate(hotkeys)}),
+            synced_at=time.time(),
+        )
+
+    def __contains__(self, hotkey: str) -> bool:
+        return hotkey in self.uids
+
+    def stake(self, hotkey: str) -> float:
+        return self.stakes[self.uids[hotkey]]
+
+    def with_active(self, available_validators: Dict[str, Dict]) -> "MetagraphSnapshot":
+        active = tuple(
+            (hotkey, self.stake(hotkey))
+            for hotkey, validator in list(available_validators.items())
+            if validator.get("is_active") and hotkey in self.uids
+        )
+        return replace(self, active_validators=active)
+
+    def to_dict(self) -> Dict:
+        return {
+            "block": self.block,
+            "hotkeys": list(self.hotkeys),
+            "stakes": list(self.stakes),
+            "synced_at": self.synced_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "MetagraphSnapshot":
+        hotkeys = tuple(data["hotkeys"])
+        return cls(
+            block=data.get("block", 0),
+            hotkeys=hotkeys,
+            stakes=tuple(data["stakes"]),
+            uids=MappingProxyType({hotkey: uid for uid, hotkey in enumerate(hotkeys)}),
+            synced_at=data.get("synced_at", 0.0),
+        )
+
+    def save(self, path: str) -> None:
+        # Warm-start cache for the next boot, written atomically
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["MetagraphSnapshot"]:
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable metagraph cache {path}: {e}", flush=True)
+            return None
+        return cls.from_dict(data)
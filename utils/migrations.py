@@ -0,0 +1,81 @@
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+from utils.common import usage_aggregate_fields, usage_bucket_id, usage_bucket_start
+from utils.rate_limit import DEFAULT_TIER
+
+USAGE_DAILY_RETENTION_DAYS = int(os.getenv("USAGE_DAILY_RETENTION_DAYS", 90))
+
+
+def migrate_usage_arrays(dbhandler) -> int:
+    # Move the legacy auth_keys[...]["usage"] arrays into the usage collection.
+    # Safe to re-run: migrated buckets are written with $set under their own ids,
+    # and the aggregates are applied in the same update that removes the array.
+    migrated = 0
+    cursor = dbhandler.auth_keys_collection.find(
+        {"usage": {"$exists": True}}, {"usage": 1, "api_keys": 1}
+    )
+    for doc in cursor:
+        account_id = doc["_id"]
+        usage = doc.get("usage") if isinstance(doc.get("usage"), list) else []
+        buckets = defaultdict(list)
+        aggregates = defaultdict(float)
+        for event in usage:
+            timestamp = event.get("timestamp")
+            if not isinstance(timestamp, datetime):
+                continue
+            buckets[usage_bucket_start(timestamp)].append(event)
+            for field, value in usage_aggregate_fields(
+                timestamp, event.get("model_name", ""), event.get("credit_cost", 0)
+            ).items():
+                aggregates[field] += value
+        requests = [
+            UpdateOne(
+                {"_id": usage_bucket_id(account_id, start) + ":migrated"},
+                {"$set": {"account_id": account_id, "start": start, "events": events, "count": len(events)}},
+                upsert=True,
+            )
+            for start, events in buckets.items()
+        ]
+        if requests:
+            dbhandler.usage_collection.bulk_write(requests, ordered=False)
+        update = {"$unset": {"usage": ""}, "$set": {"updated_at": datetime.utcnow()}}
+        if aggregates:
+            update["$inc"] = dict(aggregates)
+        dbhandler.auth_keys_collection.update_one({"_id": account_id, "usage": {"$exists": True}}, update)
+        migrated += 1
+        print(f"Migrated {len(usage)} usage events for account {account_id}", flush=True)
+    return migrated
+
+
+def prune_usage_aggregates(dbhandler, retention_days=USAGE_DAILY_RETENTION_DAYS) -> int:
+    # Keep usage_daily a rolling window instead of growing forever
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).strftime("%Y-%m-%d")
+    pruned = 0
+    for doc in dbhandler.auth_keys_collection.find({"usage_daily": {"$exists": True}}, {"usage_daily": 1}):
+        expired = {f"usage_daily.{day}": "" for day in doc.get("usage_daily", {}) if day < cutoff}
+        if expired:
+            dbhandler.auth_keys_collection.update_one({"_id": doc["_id"]}, {"$unset": expired})
+            pruned += 1
+    return pruned
+
+
+def backfill_account_tiers(dbhandler) -> int:
+    # Accounts created before tiers existed get the default one, tiers set by hand are kept
+    result = dbhandler.auth_keys_collection.update_many(
+        {"tier": {"$exists": False}}, {"$set": {"tier": DEFAULT_TIER, "updated_at": datetime.utcnow()}}
+    )
+    return result.modified_count
+
+
+if __name__ == "__main__":
+    from utils.db_client import MongoDBHandler
+
+    dbhandler = MongoDBHandler()
+    dbhandler.initialize()
+    print(f"Migrated usage for {migrate_usage_arrays(dbhandler)} accounts", flush=True)
+    print(f"Pruned usage aggregates for {prune_usage_aggregates(dbhandler)} accounts", flush=True)
+    print(f"Set the default tier on {backfill_account_tiers(dbhandler)} accounts", flush=True)
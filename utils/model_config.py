@@ -0,0 +1,93 @@
+import hashlib
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional
+
+from bson.json_util import dumps
+from prometheus_client import Gauge, Info
+from pymongo.errors import OperationFailure, PyMongoError
+
+MODEL_CONFIG_POLL_INTERVAL = float(os.getenv("MODEL_CONFIG_POLL_INTERVAL", 60))
+DEFAULT_CREDIT_COST = 0.001
+
+MODEL_CONFIG_VERSION = Info("model_config", "Version of the model config snapshot in use")
+MODEL_CONFIG_LOADED_AT = Gauge(
+    "model_config_loaded_timestamp_seconds", "When the model config snapshot in use was loaded"
+)
+
+
+@dataclass(frozen=True)
+class ModelConfigSnapshot:
+    # Treated as read-only by every reader, a change publishes a whole new snapshot
+    version: str
+    model_list: Mapping[str, Dict] = field(default_factory=dict)
+    ratio_to_size: Mapping[str, list] = field(default_factory=dict)
+    tokenizers: Mapping[str, str] = field(default_factory=dict)
+    loaded_at: float = 0.0
+
+    def credit_cost(self, model_name: str) -> float:
+        return self.model_list.get(model_name, {}).get("credit_cost", DEFAULT_CREDIT_COST)
+
+
+def build_snapshot(docs: Dict[str, Dict]) -> ModelConfigSnapshot:
+    # Explicit version fields make the version readable, the content hash makes sure an
+    # edit to a doc without one still changes it
+    versions = [str(docs[name]["version"]) for name in sorted(docs) if "version" in docs[name]]
+    content_hash = hashlib.sha1(
+        dumps([docs[name].get("data") for name in sorted(docs)]).encode()
+    ).hexdigest()[:12]
+    version = "-".join([".".join(versions), content_hash]) if versions else content_hash
+
+    def data(name):
+        doc = docs.get(name)
+        return MappingProxyType(dict(doc["data"])) if doc and doc.get("data") else MappingProxyType({})
+
+    return ModelConfigSnapshot(
+        version=version,
+        model_list=data("model_list"),
+        ratio_to_size=data("ratio-to-size"),
+        tokenizers=data("tokenizer"),
+        loaded_at=time.time(),
+    )
+
+
+class ModelConfigStore:
+    def __init__(self, collection):
+        self.collection = collection
+        self.current = ModelConfigSnapshot(version="")
+
+    def start(self) -> None:
+        self.load()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def load(self) -> Optional[ModelConfigSnapshot]:
+        docs = {doc["name"]: doc for doc in self.collection.find({}) if "name" in doc}
+        snapshot = build_snapshot(docs)
+        if snapshot.version == self.current.version:
+            return None
+        # A single attribute assignment, readers see either the old or the new snapshot
+        self.current = snapshot
+        MODEL_CONFIG_VERSION.info({"version": snapshot.version})
+        MODEL_CONFIG_LOADED_AT.set(snapshot.loaded_at)
+        print(f"Loaded model config version {snapshot.version}", flush=True)
+        return snapshot
+
+    def _watch(self) -> None:
+        try:
+            with self.collection.watch() as stream:
+                self.load()
+                for _ in stream:
+                    self.load()
+        except OperationFailure as e:
+            print(f"Model config change stream unavailable, polling instead: {e}", flush=True)
+        except PyMongoError as e:
+            print(f"Model config change stream interrupted, polling instead: {e}", flush=True)
+        while True:
+            time.sleep(MODEL_CONFIG_POLL_INTERVAL)
+            try:
+                self.load()
+            except PyMongoError as e:
+                print(f"Failed to reload model config: {e}", flush=True)
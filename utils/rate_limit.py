@@ -0,0 +1,238 @@
+import fcntl
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+from prometheus_client import Counter
+
+from constants import API_RATE_LIMIT, PRO_API_RATE_LIMIT
+
+# memory (per process) | shm (shared by the workers on one host) | redis (shared by every host)
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "shm")
+RATE_LIMIT_SHM_PATH = os.getenv(
+    "RATE_LIMIT_SHM_PATH",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "proxy-client-ratelimit"),
+)
+RATE_LIMIT_SHM_GROUPS = int(os.getenv("RATE_LIMIT_SHM_GROUPS", 8192))
+RATE_LIMIT_MEMORY_KEYS = int(os.getenv("RATE_LIMIT_MEMORY_KEYS", 100000))
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+# JSON object of tier -> "N/period", merged over the defaults below
+RATE_LIMIT_TIERS = {
+    "standard": API_RATE_LIMIT,
+    "pro": PRO_API_RATE_LIMIT,
+    **json.loads(os.getenv("RATE_LIMIT_TIERS", "{}")),
+}
+DEFAULT_TIER = "standard"
+
+PERIODS = {"second": 1, "minute": 60, "hour": 60 * 60, "day": 24 * 60 * 60}
+
+RATE_LIMIT_DECISIONS = Counter(
+    "rate_limit_decisions_total", "Rate limiter decisions", ["tier", "outcome"]
+)
+
+
+def parse_rate(rate: str) -> Tuple[float, float]:
+    # "120/minute" -> (bucket capacity, tokens refilled per second)
+    count, _, period = rate.replace(" per ", "/").partition("/")
+    period = period.strip().lower().rstrip("s")
+    if period not in PERIODS:
+        raise ValueError(f"Unknown rate limit period in {rate!r}")
+    count = float(count)
+    return count, count / PERIODS[period]
+
+
+class RateLimitResult:
+    __slots__ = ("allowed", "limit", "remaining", "retry_after", "reset_after")
+
+    def __init__(self, allowed: bool, capacity: float, rate: float, tokens: float):
+        self.allowed = allowed
+        self.limit = int(capacity)
+        self.remaining = max(int(tokens), 0)
+        # Seconds until one token is available again / until the bucket is full
+        self.retry_after = 0 if allowed else max(math.ceil((1 - tokens) / rate), 1)
+        self.reset_after = math.ceil((capacity - tokens) / rate)
+
+    def headers(self) -> Dict[str, str]:
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": str(self.reset_after),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after)
+        return headers
+
+
+def refill(tokens: float, updated_at: float, now: float, capacity: float, rate: float) -> float:
+    return min(capacity, tokens + max(now - updated_at, 0) * rate)
+
+
+class MemoryBackend:
+    def __init__(self, max_keys: int = RATE_LIMIT_MEMORY_KEYS):
+        self.max_keys = max_keys
+        # key -> [tokens, updated_at], least recently used first
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    async def acquire(self, key: str, capacity: float, rate: float, cost: float = 1) -> Tuple[bool, float]:
+        now = time.time()
+        bucket = self._buckets.get(key)
+        tokens = capacity if bucket is None else refill(bucket[0], bucket[1], now, capacity, rate)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        self._buckets[key] = [tokens, now]
+        self._buckets.move_to_end(key)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return allowed, tokens
+
+    async def close(self) -> None:
+        pass
+
+
+class SharedMemoryBackend:
+    # Fixed-size hash table in a memory-mapped file shared by every worker on the host.
+    # Keys hash to a group of slots; each group is guarded by a byte-range lock on the
+    # file, so a check costs a couple of syscalls and no I/O.
+    GROUP_SLOTS = 8
+    SLOT = struct.Struct("<Qdd")  # key hash (0 = empty), tokens, updated_at
+
+    def __init__(self, path: str = RATE_LIMIT_SHM_PATH, groups: int = RATE_LIMIT_SHM_GROUPS):
+        self.groups = groups
+        self.group_size = self.GROUP_SLOTS * self.SLOT.size
+        size = groups * self.group_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size != size:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size != size:
+                    os.ftruncate(self._fd, size)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+        # fcntl locks don't exclude threads of the same process
+        self._lock = threading.Lock()
+
+    async def acquire(self, key: str, capacity: float, rate: float, cost: float = 1) -> Tuple[bool, float]:
+        key_hash = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+        group = key_hash % self.groups
+        base = group * self.group_size
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, group)
+            try:
+                now = time.time()
+                offset, tokens, empty, least_recent = None, capacity, None, None
+                for slot in range(self.GROUP_SLOTS):
+                    slot_offset = base + slot * self.SLOT.size
+                    slot_hash, slot_tokens, slot_updated = self.SLOT.unpack_from(self._map, slot_offset)
+                    if slot_hash == key_hash:
+                        offset = slot_offset
+                        tokens = refill(slot_tokens, slot_updated, now, capacity, rate)
+                        break
+                    if slot_hash == 0:
+                        if empty is None:
+                            empty = slot_offset
+                    elif least_recent is None or slot_updated < least_recent[1]:
+                        least_recent = (slot_offset, slot_updated)
+                if offset is None:
+                    # New key: take an empty slot, otherwise evict the least recently used one
+                    offset = empty if empty is not None else least_recent[0]
+                allowed = tokens >= cost
+                if allowed:
+                    tokens -= cost
+                self.SLOT.pack_into(self._map, offset, key_hash, tokens, now)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, group)
+        return allowed, tokens
+
+    async def close(self) -> None:
+        self._map.close()
+        os.close(self._fd)
+
+
+# Refill and take in one round trip; the server clock is used so workers' clocks don't matter
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 't', 'u')
+local tokens = tonumber(state[1])
+local updated = tonumber(state[2])
+if tokens == nil then
+  tokens = capacity
+  updated = now
+end
+tokens = math.min(capacity, tokens + math.max(now - updated, 0) * rate)
+local allowed = 0
+if tokens >= cost then
+  tokens = tokens - cost
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 't', tostring(tokens), 'u', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisBackend:
+    # Any server speaking the Redis protocol with Lua scripting works
+    def __init__(self, url: str = RATE_LIMIT_REDIS_URL):
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+        self._script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    async def acquire(self, key: str, capacity: float, rate: float, cost: float = 1) -> Tuple[bool, float]:
+        allowed, tokens = await self._script(keys=[f"ratelimit:{key}"], args=[capacity, rate, cost])
+        return bool(allowed), float(tokens)
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+def create_backend(name: str = RATE_LIMIT_BACKEND):
+    if name == "memory":
+        return MemoryBackend()
+    if name == "shm":
+        return SharedMemoryBackend()
+    if name == "redis":
+        return RedisBackend()
+    raise ValueError(f"Unknown rate limit backend: {name}")
+
+
+class RateLimiter:
+    def __init__(self, backend=None):
+        self.backend = backend or create_backend()
+        self._rates = {tier: parse_rate(rate) for tier, rate in RATE_LIMIT_TIERS.items()}
+        print(f"Rate limiter backend: {type(self.backend).__name__}", flush=True)
+
+    def rate_for(self, account) -> Tuple[str, float, float]:
+        # (tier, capacity, refill rate); an account can carry its own "rate_limit" override
+        tier = (account or {}).get("tier", DEFAULT_TIER)
+        if account and account.get("rate_limit"):
+            return tier, *parse_rate(account["rate_limit"])
+        return tier, *self._rates.get(tier, self._rates[DEFAULT_TIER])
+
+    async def check(self, key: str, account=None) -> RateLimitResult:
+        tier, capacity, rate = self.rate_for(account)
+        try:
+            allowed, tokens = await self.backend.acquire(key, capacity, rate)
+        except Exception as e:
+            # A broken limiter store shouldn't take the API down with it
+            print(f"Rate limiter unavailable, allowing request: {e}", flush=True)
+            allowed, tokens = True, capacity
+        RATE_LIMIT_DECISIONS.labels(tier=tier, outcome="allowed" if allowed else "limited").inc()
+        return RateLimitResult(allowed, capacity, rate, tokens)
+
+    async def close(self) -> None:
+        await self.backend.close()
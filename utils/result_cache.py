@@ -0,0 +1,204 @@
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "false").lower() == "true"
+RESULT_CACHE_MEMORY_ITEMS = int(os.getenv("RESULT_CACHE_MEMORY_ITEMS", 256))
+# Empty disables the disk tier
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_BYTES = int(os.getenv("RESULT_CACHE_DISK_BYTES", 2 * 1024 * 1024 * 1024))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 24 * 60 * 60))
+# Fraction of the model's credit cost charged for a cache hit: 1 bills hits in full, 0 makes them free
+RESULT_CACHE_HIT_COST_RATIO = float(os.getenv("RESULT_CACHE_HIT_COST_RATIO", 1))
+
+RESULT_CACHE_LOOKUPS = Counter(
+    "result_cache_lookups_total",
+    "Generation result cache lookups",
+    ["result"],
+)
+RESULT_CACHE_DISK_USAGE = Gauge(
+    "result_cache_disk_bytes", "Bytes held by the on-disk generation result cache"
+)
+
+
+def cache_key(prompt) -> str:
+    # Canonical hash of everything that determines the output, the API key doesn't
+    payload = dict(prompt)
+    payload.pop("key", None)
+    canonical = json.dumps(
+        [type(prompt).__name__, payload], sort_keys=True, separators=(",", ":"), default=str
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    def __init__(
+        self,
+        enabled: bool = RESULT_CACHE_ENABLED,
+        memory_items: int = RESULT_CACHE_MEMORY_ITEMS,
+        directory: str = RESULT_CACHE_DIR,
+        disk_bytes: int = RESULT_CACHE_DISK_BYTES,
+        ttl: float = RESULT_CACHE_TTL,
+    ):
+        self.enabled = enabled
+        self.memory_items = memory_items
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        # key -> (stored_at, value), least recently used first
+        self._memory: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        # key -> file size, least recently used first
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_lock = threading.Lock()
+        self._disk_total = 0
+        # key -> future resolved by the request currently computing it
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def start(self) -> None:
+        if self.enabled and self.directory:
+            await asyncio.to_thread(self._scan_disk)
+
+    async def get_or_compute(
+        self, key: str, compute: Callable[[], Awaitable[Optional[Dict]]]
+    ) -> Tuple[Optional[Dict], bool]:
+        # Returns (value, hit). Identical concurrent requests wait for the one
+        # in flight instead of each dispatching to a validator.
+        while True:
+            value = await self.get(key)
+            if value is not None:
+                return value, True
+            future = self._in_flight.get(key)
+            if future is None:
+                break
+            RESULT_CACHE_LOOKUPS.labels(result="coalesced").inc()
+            value = await asyncio.shield(future)
+            if value is not None:
+                return copy.deepcopy(value), True
+            # The leader failed (no credit, no validator, ...), that's not our
+            # failure: go round again and become the leader ourselves
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        shared = None
+        try:
+            value = await compute()
+            # Anything else (no output, a rejection) is specific to this request
+            if isinstance(value, dict) and value:
+                await self.put(key, value)
+                shared = copy.deepcopy(value)
+        finally:
+            del self._in_flight[key]
+            future.set_result(shared)
+        return value, False
+
+    async def get(self, key: str) -> Optional[Dict]:
+        entry = self._memory.get(key)
+        if entry is not None:
+            stored_at, value = entry
+            if time.time() - stored_at <= self.ttl:
+                self._memory.move_to_end(key)
+                RESULT_CACHE_LOOKUPS.labels(result="memory_hit").inc()
+                # Handlers add fields to the output, never hand out the cached object
+                return copy.deepcopy(value)
+            del self._memory[key]
+        if self.directory and key in self._disk:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None:
+                stored_at, value = entry
+                self._put_memory(key, stored_at, value)
+                RESULT_CACHE_LOOKUPS.labels(result="disk_hit").inc()
+                return copy.deepcopy(value)
+        RESULT_CACHE_LOOKUPS.labels(result="miss").inc()
+        return None
+
+    async def put(self, key: str, value: Dict) -> None:
+        stored_at = time.time()
+        self._put_memory(key, stored_at, copy.deepcopy(value))
+        if self.directory:
+            try:
+                await asyncio.to_thread(self._write_disk, key, stored_at, value)
+            except (OSError, TypeError, ValueError) as e:
+                print(f"Failed to write result cache entry {key}: {e}", flush=True)
+
+    def _put_memory(self, key: str, stored_at: float, value: Dict) -> None:
+        self._memory[key] = (stored_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _scan_disk(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[: -len(".json")], stat.st_size))
+        with self._disk_lock:
+            for _, key, size in sorted(entries):
+                self._disk[key] = size
+                self._disk_total += size
+            self._evict_disk_locked()
+        print(f"Loaded {len(self._disk)} result cache entries from {self.directory}", flush=True)
+
+    def _read_disk(self, key: str) -> Optional[Tuple[float, Dict]]:
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self._remove_disk(key)
+            return None
+        if time.time() - entry["stored_at"] > self.ttl:
+            self._remove_disk(key)
+            return None
+        with self._disk_lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+        try:
+            # mtime orders entries for eviction after a restart
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return entry["stored_at"], entry["value"]
+
+    def _write_disk(self, key: str, stored_at: float, value: Dict) -> None:
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"stored_at": stored_at, "value": value}, f)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self._disk_lock:
+            self._disk_total += size - self._disk.pop(key, 0)
+            self._disk[key] = size
+            self._evict_disk_locked()
+
+    def _remove_disk(self, key: str) -> None:
+        with self._disk_lock:
+            self._disk_total -= self._disk.pop(key, 0)
+            RESULT_CACHE_DISK_USAGE.set(self._disk_total)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict_disk_locked(self) -> None:
+        while self._disk_total > self.disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_total -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+        RESULT_CACHE_DISK_USAGE.set(self._disk_total)
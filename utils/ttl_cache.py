@@ -0,0 +1,48 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from prometheus_client import Counter, Gauge
+
+TTL_CACHE_LOOKUPS = Counter(
+    "ttl_cache_lookups_total",
+    "Lookups in in-memory TTL caches",
+    ["cache", "result"],
+)
+TTL_CACHE_SIZE = Gauge("ttl_cache_entries", "Entries held by in-memory TTL caches", ["cache"])
+
+
+class TTLCache:
+    # Bounded LRU whose entries also expire ttl seconds after they were stored
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (expires_at, value), least recently used first
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        TTL_CACHE_LOOKUPS.labels(cache=self.name, result="hit" if entry is not None else "miss").inc()
+        return entry[1] if entry is not None else None
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            TTL_CACHE_SIZE.labels(cache=self.name).set(len(self._entries))
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,263 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", 1))
+WRITE_BEHIND_FLUSH_SIZE = int(os.getenv("WRITE_BEHIND_FLUSH_SIZE", 500))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", 10000))
+# Longest an async caller waits for room in a full queue (MongoDB down or slow)
+WRITE_BEHIND_CAPACITY_TIMEOUT = float(os.getenv("WRITE_BEHIND_CAPACITY_TIMEOUT", 2))
+
+WRITE_BEHIND_PENDING = Gauge(
+    "write_behind_pending_operations", "MongoDB writes queued and not yet flushed"
+)
+WRITE_BEHIND_FLUSHED = Counter(
+    "write_behind_flushed_operations_total", "MongoDB writes flushed by the write-behind queue", ["kind"]
+)
+WRITE_BEHIND_ERRORS = Counter(
+    "write_behind_flush_errors_total", "Failed write-behind flushes (the batch is re-queued)"
+)
+WRITE_BEHIND_OVERFLOW = Counter(
+    "write_behind_overflow_operations_total", "Writes queued on the event loop past WRITE_BEHIND_MAX_PENDING"
+)
+WRITE_BEHIND_DROPPED = Counter(
+    "write_behind_dropped_operations_total", "Writes skipped because the queue stayed full", ["kind"]
+)
+
+
+class WriteBehindQueue:
+    # Flushes are at-least-once: a batch that fails after the server applied it
+    # (a network error on the reply) is re-queued and its $inc deltas applied
+    # again. Only counters that tolerate that go through here, never credit.
+    def __init__(self, db):
+        self.db = db
+        self._lock = threading.Lock()
+        # (collection, _id) -> {"$inc": {...}, "$set": {...}, "$push": {field: [values]}}
+        self._updates: Dict[Tuple[str, object], Dict] = {}
+        # collection -> [documents]
+        self._inserts: Dict[str, List[Dict]] = {}
+        self._pending = 0
+        # Taken out by a flush and not written yet, still counts against the limit
+        self._in_flight = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._stopping
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        # Drain everything still queued before the process exits
+        self._stopping = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        if self._pending:
+            print(f"Write-behind queue stopped with {self._pending} unflushed writes", flush=True)
+
+    def increment(self, collection: str, _id, inc: Dict, set_fields: Optional[Dict] = None, upsert: bool = False) -> None:
+        def apply(update):
+            for field, value in inc.items():
+                update["$inc"][field] = update["$inc"].get(field, 0) + value
+            update["$set"].update(set_fields or {})
+            return 0
+        self._enqueue(collection, _id, apply, upsert)
+
+    def push(self, collection: str, _id, field: str, value, set_fields: Optional[Dict] = None, upsert: bool = False) -> None:
+        def apply(update):
+            update["$push"].setdefault(field, []).append(value)
+            update["$set"].update(set_fields or {})
+            return 1
+        self._enqueue(collection, _id, apply, upsert)
+
+    def insert(self, collection: str, document: Dict) -> None:
+        if not self._reserve():
+            self.db[collection].insert_one(document)
+            return
+        with self._lock:
+            self._inserts.setdefault(collection, []).append(document)
+            self._pending += 1
+            pending = self._pending
+        self._after_enqueue(pending)
+
+    async def wait_for_capacity(self, timeout: float = WRITE_BEHIND_CAPACITY_TIMEOUT) -> bool:
+        # Backpressure for async callers, so they never fall back to a blocking write.
+        # False when the queue is still full after timeout: the caller drops what it
+        # can do without (see dropped()), anything else is queued past the limit
+        give_up_at = time.monotonic() + timeout
+        while self.running and self._queued >= WRITE_BEHIND_MAX_PENDING:
+            if time.monotonic() >= give_up_at:
+                return False
+            self._wake()
+            await asyncio.sleep(0.01)
+        return True
+
+    def dropped(self, kind: str, count: int = 1) -> None:
+        WRITE_BEHIND_DROPPED.labels(kind=kind).inc(count)
+
+    @property
+    def _queued(self) -> int:
+        return self._pending + self._in_flight
+
+    def _enqueue(self, collection: str, _id, apply, upsert: bool) -> None:
+        if not self._reserve():
+            update = {"$inc": {}, "$set": {}, "$push": {}}
+            apply(update)
+            self.db[collection].update_one({"_id": _id}, self._to_mongo_update(update), upsert=upsert)
+            return
+        with self._lock:
+            update = self._updates.get((collection, _id))
+            added = 0
+            if update is None:
+                update = self._updates[(collection, _id)] = {"$inc": {}, "$set": {}, "$push": {}, "upsert": False}
+                added = 1
+            update["upsert"] = update["upsert"] or upsert
+            self._pending += added + apply(update)
+            pending = self._pending
+        self._after_enqueue(pending)
+
+    def _reserve(self) -> bool:
+        # False means the caller should write synchronously, only while the queue
+        # isn't running (before start, after stop)
+        if not self.running:
+            return False
+        if self._queued < WRITE_BEHIND_MAX_PENDING:
+            return True
+        if self._on_loop_thread():
+            # The loop can't block: queue past the limit. Async callers await
+            # wait_for_capacity() before their writes, so this stays a handful of
+            # writes per request over the limit
+            WRITE_BEHIND_OVERFLOW.inc()
+            self._wake()
+            return True
+        while self.running and self._queued >= WRITE_BEHIND_MAX_PENDING:
+            self._wake()
+            time.sleep(0.01)
+        return self.running
+
+    def _on_loop_thread(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _after_enqueue(self, pending: int) -> None:
+        WRITE_BEHIND_PENDING.set(pending + self._in_flight)
+        if pending >= WRITE_BEHIND_FLUSH_SIZE:
+            self._wake()
+
+    def _wake(self) -> None:
+        if self._loop is None or self._wakeup is None:
+            return
+        if self._on_loop_thread():
+            self._wakeup.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), WRITE_BEHIND_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        with self._lock:
+            updates, inserts = self._updates, self._inserts
+            self._updates, self._inserts = {}, {}
+            self._in_flight, self._pending = self._pending, 0
+        if not updates and not inserts:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, updates, inserts)
+        except Exception as e:
+            print(f"Write-behind flush failed, re-queueing: {e}", flush=True)
+            WRITE_BEHIND_ERRORS.inc()
+            self._requeue(updates, inserts)
+        finally:
+            with self._lock:
+                self._in_flight = 0
+                WRITE_BEHIND_PENDING.set(self._pending)
+
+    def _write(self, updates: Dict, inserts: Dict) -> None:
+        # Entries are removed as soon as they are written, so a failure part-way
+        # only re-queues what didn't make it
+        for collection in {collection for collection, _ in updates}:
+            keys = [key for key in updates if key[0] == collection]
+            requests = [
+                UpdateOne({"_id": key[1]}, self._to_mongo_update(updates[key]), upsert=updates[key]["upsert"])
+                for key in keys
+            ]
+            try:
+                self.db[collection].bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                # Per-document errors won't succeed on retry and the rest of the batch
+                # was applied, so report them instead of re-queueing
+                print(f"Write-behind dropped updates on {collection}: {e.details.get('writeErrors')}", flush=True)
+                WRITE_BEHIND_ERRORS.inc()
+            WRITE_BEHIND_FLUSHED.labels(kind="update").inc(len(requests))
+            for key in keys:
+                del updates[key]
+        for collection in list(inserts):
+            documents = inserts[collection]
+            try:
+                self.db[collection].insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                # insert_many assigns _id in place, so a retried batch reports the
+                # documents that already made it as duplicates
+                if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+            WRITE_BEHIND_FLUSHED.labels(kind="insert").inc(len(documents))
+            del inserts[collection]
+
+    def _requeue(self, updates: Dict, inserts: Dict) -> None:
+        with self._lock:
+            for key, update in updates.items():
+                current = self._updates.get(key)
+                if current is None:
+                    self._updates[key] = update
+                    self._pending += 1 + sum(len(values) for values in update["$push"].values())
+                    continue
+                for field, value in update["$inc"].items():
+                    current["$inc"][field] = current["$inc"].get(field, 0) + value
+                current["upsert"] = current["upsert"] or update["upsert"]
+                # Newer $set values win
+                current["$set"] = {**update["$set"], **current["$set"]}
+                for field, values in update["$push"].items():
+                    current["$push"][field] = values + current["$push"].get(field, [])
+                    self._pending += len(values)
+            for collection, documents in inserts.items():
+                self._inserts[collection] = documents + self._inserts.get(collection, [])
+                self._pending += len(documents)
+            WRITE_BEHIND_PENDING.set(self._pending)
+
+    @staticmethod
+    def _to_mongo_update(update: Dict) -> Dict:
+        mongo_update = {}
+        if update["$inc"]:
+            mongo_update["$inc"] = update["$inc"]
+        if update["$set"]:
+            mongo_update["$set"] = update["$set"]
+        if update["$push"]:
+            mongo_update["$push"] = {
+                field: {"$each": values} for field, values in update["$push"].items()
+            }
+        return mongo_update